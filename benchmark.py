@@ -0,0 +1,550 @@
+"""Offline load test for the bot.
+
+Runs the real webhook app and handlers from main.py against local stub Bot API and
+Pixabay servers, drives synthetic /start, search and navigation updates into /webhook
+(or through getUpdates with --mode polling) at a target rate and reports throughput, end-to-end latency, database time and API
+calls per update. No network access is needed.
+
+    python benchmark.py --users 50 --rate 100 --duration 30
+    python benchmark.py --pixabay-latency 0.3 --bot-error-rate 0.01 --json before.json
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import httpx
+
+BENCH_TOKEN = "123456:benchmark"
+BENCH_BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+FIRST_USER_ID = 1_000_000
+SEARCH_WORDS = ("cat", "dog", "sunset", "mountain", "ocean", "city", "forest", "flower", "car", "coffee",
+                "space", "bird", "rain", "snow", "beach", "desert", "river", "bridge", "music", "food")
+
+class StubServer:
+    """Threaded local HTTP server answering with injected latency and errors"""
+
+    def __init__(self, latency: float = 0, error_rate: float = 0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.url = ""
+        self.calls: Counter = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def start(self) -> str:
+        """Start serving on a free local port and return the base URL"""
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes; avoid the delayed-ACK stall
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                stub._serve(self)
+
+            do_POST = do_HEAD = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+        return self.url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def count(self, name: str):
+        with self._lock:
+            self.calls[name] += 1
+
+    def snapshot(self) -> Counter:
+        with self._lock:
+            return Counter(self.calls)
+
+    def _serve(self, handler: BaseHTTPRequestHandler):
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = handler.rfile.read(length) if length else b""
+        with self._lock:
+            jitter = self._random.uniform(0.5, 1.5)
+            inject_error = self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency * jitter)
+
+        status, headers, payload = self.respond(handler, body, inject_error)
+        data = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        if handler.command != "HEAD":
+            handler.wfile.write(data)
+
+    def respond(self, handler: BaseHTTPRequestHandler, body: bytes, inject_error: bool) -> tuple:
+        """Return (status, headers, JSON payload) for a request"""
+        raise NotImplementedError
+
+class StubBotAPI(StubServer):
+    """Bot API stand-in that remembers the last message and keyboard sent to each chat"""
+
+    MEDIA_METHODS = {"sendPhoto": "photo", "sendVideo": "video", "sendAudio": "audio", "sendAnimation": "animation"}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.webhook_url = ""
+        self.allowed_updates: List[str] = []
+        self._message_ids = 0
+        self._messages: Dict[int, Dict] = {}
+        # Updates waiting to be fetched with getUpdates
+        self._updates: List[Dict] = []
+        self._updates_added = threading.Condition(self._lock)
+
+    def push_update(self, update: Dict):
+        """Queue an update for getUpdates"""
+        with self._updates_added:
+            self._updates.append(update)
+            self._updates_added.notify_all()
+
+    def _get_updates(self, params: Dict) -> List[Dict]:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        with self._updates_added:
+            # Requesting an offset confirms every update below it
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_added.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+    def last_message(self, chat_id: int) -> Optional[Dict]:
+        with self._lock:
+            return self._messages.get(chat_id)
+
+    @staticmethod
+    def _params(handler: BaseHTTPRequestHandler, body: bytes) -> Dict:
+        content_type = handler.headers.get("Content-Type", "")
+        if "application/x-www-form-urlencoded" in content_type:
+            return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        if "application/json" in content_type and body:
+            return json.loads(body)
+        return {}
+
+    def respond(self, handler, body, inject_error):
+        method = urlparse(handler.path).path.rsplit("/", 1)[-1]
+        self.count(method)
+        if inject_error:
+            return 500, {}, {"ok": False, "error_code": 500, "description": "Internal Server Error: injected"}
+        return 200, {}, {"ok": True, "result": self._result(method, self._params(handler, body))}
+
+    def _result(self, method: str, params: Dict):
+        if method == "getMe":
+            return BENCH_BOT_USER
+        if method == "getChatMember":
+            user = {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "user"}
+            return {"status": "member", "user": user}
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method == "getWebhookInfo":
+            return {"url": self.webhook_url, "has_custom_certificate": False, "pending_update_count": 0,
+                    "allowed_updates": self.allowed_updates}
+        if method == "setWebhook":
+            self.webhook_url = params.get("url", "")
+            self.allowed_updates = json.loads(params.get("allowed_updates", "[]"))
+            return True
+        if method == "deleteWebhook":
+            self.webhook_url = ""
+            return True
+        if method.startswith("send") or method.startswith("edit"):
+            return self._message(method, params)
+        return True
+
+    def _message(self, method: str, params: Dict) -> Dict:
+        chat_id = int(params.get("chat_id") or 0)
+        with self._lock:
+            previous = self._messages.get(chat_id, {})
+            if method.startswith("edit") and params.get("message_id"):
+                message_id = int(params["message_id"])
+            else:
+                self._message_ids += 1
+                message_id = self._message_ids
+
+        if method in self.MEDIA_METHODS:
+            kind = self.MEDIA_METHODS[method]
+        elif method == "editMessageMedia":
+            kind = json.loads(params.get("media", "{}")).get("type")
+        elif method == "editMessageCaption":
+            kind = previous.get("kind")
+        else:
+            kind = None
+
+        message = {"message_id": message_id, "date": int(time.time()), "from": BENCH_BOT_USER,
+                   "chat": {"id": chat_id, "type": "private"}}
+        file = {"file_id": f"{kind}-{message_id}", "file_unique_id": f"u{kind}-{message_id}"}
+        if kind == "photo":
+            message["photo"] = [dict(file, width=640, height=427)]
+        elif kind in ("video", "animation"):
+            message[kind] = dict(file, width=640, height=360, duration=10)
+            if kind == "animation":
+                message["document"] = file
+        elif kind == "audio":
+            message["audio"] = dict(file, duration=30)
+        if kind:
+            message["caption"] = params.get("caption", "")
+        else:
+            message["text"] = params.get("text", "")
+        if params.get("reply_markup"):
+            message["reply_markup"] = json.loads(params["reply_markup"])
+
+        with self._lock:
+            self._messages[chat_id] = dict(message, kind=kind)
+        return message
+
+class StubPixabay(StubServer):
+    """Pixabay stand-in returning deterministic hits and serving their media URLs"""
+
+    def __init__(self, *args, total_hits: int = 100, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.total_hits = total_hits
+
+    def respond(self, handler, body, inject_error):
+        url = urlparse(handler.path)
+        if url.path.startswith("/media/"):
+            self.count("media")
+            return 200, {}, {}
+
+        self.count("search")
+        if inject_error:
+            return 500, {}, {"error": "injected"}
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        query = params.get("q", "")
+        page = int(params.get("page", 1))
+        per_page = int(params.get("per_page", 20))
+        first = (page - 1) * per_page
+        base_id = zlib.crc32(query.encode()) % 100_000 * 1000
+        hits = [self._hit(base_id + i, query) for i in range(first, min(first + per_page, self.total_hits))]
+        headers = {"X-RateLimit-Limit": "100000", "X-RateLimit-Remaining": "99999", "X-RateLimit-Reset": "60"}
+        return 200, headers, {"total": self.total_hits, "totalHits": self.total_hits, "hits": hits}
+
+    def _hit(self, hit_id: int, query: str) -> Dict:
+        media = f"{self.url}/media/{hit_id}"
+        return {
+            "id": hit_id,
+            "tags": f"{query}, benchmark",
+            "webformatURL": f"{media}.jpg",
+            "largeImageURL": f"{media}_large.jpg",
+            "previewURL": f"{media}.mp3",
+            "videos": {"medium": {"url": f"{media}.mp4"}},
+            "user": "benchmark"
+        }
+
+class VirtualUser:
+    """One simulated user cycling through /start, a search and a run of result navigation"""
+
+    def __init__(self, user_id: int, queries: List[str], nav_steps: int, rng: random.Random):
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        self.queries = queries
+        self.nav_steps = nav_steps
+        self.rng = rng
+        self.step = 0
+
+    def next_update(self, update_id: int, stub_bot: StubBotAPI) -> tuple:
+        """Build the next update to send as (kind, update data)"""
+        chat_id = self.user["id"]
+        last = stub_bot.last_message(chat_id)
+        if self.step == 0 or last is None:
+            self.step = 0
+            return "start", self._message(update_id, "/start", command=True)
+        if self.step == 1:
+            return "menu", self._callback(update_id, "start_search", last)
+        if self.step == 2:
+            return "search", self._message(update_id, self.rng.choice(self.queries))
+
+        buttons = last.get("reply_markup", {}).get("inline_keyboard", [])
+        if not buttons or len(buttons[0]) < 2:
+            # The search did not produce a result to page through; start over
+            self.step = 1
+            return "menu", self._callback(update_id, "start_search", last)
+        return "nav", self._callback(update_id, buttons[0][1]["callback_data"], last)
+
+    def advance(self):
+        self.step = self.step + 1 if self.step < 2 + self.nav_steps else 1
+
+    def _message(self, update_id: int, text: str, command: bool = False) -> Dict:
+        message = {"message_id": update_id, "date": int(time.time()), "from": self.user,
+                   "chat": {"id": self.user["id"], "type": "private"}, "text": text}
+        if command:
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": update_id, "message": message}
+
+    def _callback(self, update_id: int, data: str, message: Dict) -> Dict:
+        message = {key: value for key, value in message.items() if key != "kind"}
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": self.user, "chat_instance": "benchmark", "data": data, "message": message}}
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, int(round(pct / 100 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+class LoadGenerator:
+    """Delivers updates at a target rate and times each until its handler finishes
+
+    Updates are posted to webhook_url, or queued on the stub Bot API for getUpdates when it is None.
+    """
+
+    def __init__(self, webhook_url: Optional[str], stub_bot: StubBotAPI, users: List[VirtualUser], rate: float,
+                 duration: float, timeout: float):
+        self.webhook_url = webhook_url
+        self.stub_bot = stub_bot
+        self.users = users
+        self.rate = rate
+        self.duration = duration
+        self.timeout = timeout
+        self.latencies: Dict[str, List[float]] = {}
+        self.sent = 0
+        self.timed_out = 0
+        self.http_errors = 0
+        self.elapsed = 0.0
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._update_ids = 0
+
+    def mark_done(self, update_id: int, finished_at: float):
+        """Record that an update was processed; called from the bot's event loop"""
+        self._loop.call_soon_threadsafe(self._complete, update_id, finished_at)
+
+    def _complete(self, update_id: int, finished_at: float):
+        future = self._pending.pop(update_id, None)
+        if future is not None and not future.done():
+            future.set_result(finished_at)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        idle: asyncio.Queue = asyncio.Queue()
+        for user in self.users:
+            idle.put_nowait(user)
+
+        limits = httpx.Limits(max_connections=100, max_keepalive_connections=100)
+        async with httpx.AsyncClient(timeout=self.timeout, limits=limits) as client:
+            tasks = set()
+            interval = 1 / self.rate
+            started = time.perf_counter()
+            next_at = started
+            while time.perf_counter() - started < self.duration:
+                # Each user waits for its previous update before sending the next one
+                user = await idle.get()
+                now = time.perf_counter()
+                if next_at > now:
+                    await asyncio.sleep(next_at - now)
+                # Do not burst to catch up after falling more than a second behind
+                next_at = max(next_at + interval, time.perf_counter() - 1)
+                task = asyncio.create_task(self._interact(client, user, idle))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+            self.elapsed = time.perf_counter() - started
+
+    async def _interact(self, client: httpx.AsyncClient, user: VirtualUser, idle: asyncio.Queue):
+        self._update_ids += 1
+        update_id = self._update_ids
+        kind, update = user.next_update(update_id, self.stub_bot)
+        future = self._loop.create_future()
+        self._pending[update_id] = future
+        self.sent += 1
+        sent_at = time.perf_counter()
+        try:
+            if self.webhook_url is None:
+                self.stub_bot.push_update(update)
+            else:
+                response = await client.post(self.webhook_url, json=update)
+                if response.status_code != 200:
+                    self.http_errors += 1
+                    return
+            finished_at = await asyncio.wait_for(future, self.timeout)
+            self.latencies.setdefault(kind, []).append(finished_at - sent_at)
+            user.advance()
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+        except httpx.HTTPError:
+            self.http_errors += 1
+        finally:
+            self._pending.pop(update_id, None)
+            idle.put_nowait(user)
+
+def build_report(args, generator: LoadGenerator, bot_calls: Counter, pixabay_calls: Counter,
+                 db_time: float, db_calls: int, dispatcher_stats: Dict) -> Dict:
+    completed = sum(len(values) for values in generator.latencies.values())
+    per_update = max(completed, 1)
+    searches = max(len(generator.latencies.get("search", [])), 1)
+
+    latency = {}
+    all_latencies = sorted(value for values in generator.latencies.values() for value in values)
+    for kind, values in sorted(generator.latencies.items()) + [("all", all_latencies)]:
+        values = sorted(values)
+        latency[kind] = {
+            "count": len(values),
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "max_ms": (values[-1] if values else 0) * 1000
+        }
+
+    return {
+        "config": vars(args),
+        "sent": generator.sent,
+        "completed": completed,
+        "timed_out": generator.timed_out,
+        "http_errors": generator.http_errors,
+        "shed": dispatcher_stats.get("shed", 0),
+        "failed": dispatcher_stats.get("failed", 0),
+        "elapsed_s": generator.elapsed,
+        "updates_per_s": completed / generator.elapsed if generator.elapsed else 0,
+        "latency": latency,
+        "db_ms_per_update": db_time * 1000 / per_update,
+        "db_calls_per_update": db_calls / per_update,
+        "bot_api_calls_per_update": sum(bot_calls.values()) / per_update,
+        "bot_api_calls": dict(bot_calls.most_common()),
+        "pixabay_searches_per_search": pixabay_calls.get("search", 0) / searches,
+        "pixabay_calls": dict(pixabay_calls)
+    }
+
+def print_report(report: Dict):
+    print()
+    print(f"Updates: {report['sent']} sent, {report['completed']} completed, {report['timed_out']} timed out, "
+          f"{report['http_errors']} HTTP errors, {report['shed']} shed, {report['failed']} failed")
+    print(f"Throughput: {report['updates_per_s']:.1f} updates/s over {report['elapsed_s']:.1f}s "
+          f"(target {report['config']['rate']:g}/s)")
+    print()
+    print(f"{'latency':<10}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind, row in report["latency"].items():
+        print(f"{kind:<10}{row['count']:>8}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+              f"{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}")
+    print()
+    print(f"DB: {report['db_ms_per_update']:.2f} ms and {report['db_calls_per_update']:.2f} calls per update")
+    print(f"Bot API: {report['bot_api_calls_per_update']:.2f} calls per update "
+          f"({', '.join(f'{method} {count}' for method, count in report['bot_api_calls'].items())})")
+    print(f"Pixabay: {report['pixabay_searches_per_search']:.2f} searches per search update, "
+          f"{report['pixabay_calls'].get('media', 0)} media checks")
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline load test against stub Bot API and Pixabay servers")
+    parser.add_argument("--mode", choices=("webhook", "polling"), default="webhook", help="how updates reach the bot")
+    parser.add_argument("--users", type=int, default=50, help="simulated users")
+    parser.add_argument("--rate", type=float, default=50, help="target updates per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to generate load")
+    parser.add_argument("--nav-steps", type=int, default=5, help="navigation presses after each search")
+    parser.add_argument("--queries", type=int, default=50, help="distinct search queries")
+    parser.add_argument("--channels", type=int, default=0, help="mandatory channels to check membership of")
+    parser.add_argument("--bot-latency", type=float, default=0.03, help="seconds per Bot API call")
+    parser.add_argument("--bot-error-rate", type=float, default=0, help="fraction of Bot API calls that fail")
+    parser.add_argument("--pixabay-latency", type=float, default=0.15, help="seconds per Pixabay request")
+    parser.add_argument("--pixabay-error-rate", type=float, default=0, help="fraction of Pixabay searches that fail")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for one update")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", metavar="PATH", help="also write the report as JSON")
+    return parser.parse_args()
+
+def run():
+    args = parse_args()
+    stub_bot = StubBotAPI(args.bot_latency, args.bot_error_rate, seed=args.seed)
+    stub_pixabay = StubPixabay(args.pixabay_latency, args.pixabay_error_rate, seed=args.seed)
+    bot_url = stub_bot.start()
+    pixabay_url = stub_pixabay.start()
+    workdir = tempfile.mkdtemp(prefix="bot-benchmark-")
+
+    # Point the bot at the stubs before main.py reads its configuration
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "ADMIN_ID": "1",
+        "TELEGRAM_API_URL": f"{bot_url}/bot",
+        "PIXABAY_API_URL": f"{pixabay_url}/api/",
+        "PIXABAY_API_KEY": "benchmark",
+        "PIXABAY_API_KEYS": "benchmark",
+        "PIXABAY_CACHE_PATH": "",
+        "UPDATE_MODE": args.mode,
+        # Completion is observed in this process, so handlers must run here rather than in shard workers
+        "UPDATE_SHARDS": "1",
+        "POLL_TIMEOUT": "5",
+        "DB_PATH": os.path.join(workdir, "bot_database.db"),
+        "HISTORY_ARCHIVE_DIR": os.path.join(workdir, "history_archive")
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    bot_main = importlib.import_module("main")
+    logging.getLogger().setLevel(logging.WARNING)
+    for name in ("main", "httpx", "werkzeug", "telegram", "apscheduler"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    from werkzeug.serving import make_server
+
+    for i in range(args.channels):
+        bot_main.db.add_mandatory_channel(f"-100{i}", f"@benchmark{i}", 1)
+
+    rng = random.Random(args.seed)
+    queries = [f"{rng.choice(SEARCH_WORDS)} {i}" for i in range(args.queries)]
+    users = [VirtualUser(FIRST_USER_ID + i, queries, args.nav_steps, random.Random(args.seed + i))
+             for i in range(args.users)]
+
+    server = make_server("127.0.0.1", 0, bot_main.create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+    webhook_url = f"http://127.0.0.1:{server.server_port}/webhook" if args.mode == "webhook" else None
+    generator = LoadGenerator(webhook_url, stub_bot, users, args.rate, args.duration, args.timeout)
+
+    # Runs after the bot's own handlers, so it marks the end of each update
+    async def mark_done(update: Update, context):
+        generator.mark_done(update.update_id, time.perf_counter())
+    bot_main.bot.application.add_handler(TypeHandler(Update, mark_done), group=1)
+
+    bot_main.dispatcher.start()
+    bot_main.dispatcher.run(bot_main.start_bot())
+    bot_calls_before = stub_bot.snapshot()
+    pixabay_calls_before = stub_pixabay.snapshot()
+    db_time_before, db_calls_before = bot_main.metrics.total("bot_db_query_seconds")
+    print(f"Running {args.users} users at {args.rate:g} updates/s for {args.duration:g}s in {args.mode} mode ...")
+
+    try:
+        asyncio.run(generator.run())
+    finally:
+        dispatcher_stats = bot_main.dispatcher.stats()
+        bot_main.dispatcher.run(bot_main.poller.stop(), 10)
+        bot_main.dispatcher.stop(bot_main.stop_bot())
+        server.shutdown()
+        stub_bot.stop()
+        stub_pixabay.stop()
+
+    # Background flushes of accounting and sessions are charged to the updates that caused them
+    db_time, db_calls = bot_main.metrics.total("bot_db_query_seconds")
+    report = build_report(args, generator, stub_bot.snapshot() - bot_calls_before,
+                          stub_pixabay.snapshot() - pixabay_calls_before,
+                          db_time - db_time_before, db_calls - db_calls_before, dispatcher_stats)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    run()
@@ -1,18 +1,38 @@
 import logging
+import re
 import sqlite3
 import asyncio
 import os
 import json
-from datetime import datetime
+import gzip
+import time
+import heapq
+import hmac
+import hashlib
+import base64
+import struct
+import secrets
+import bisect
+import functools
+import random
+import contextvars
+import contextlib
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any
-import requests
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot
+import httpx
+from telegram import (Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot, Message,
+                      InputMediaPhoto, InputMediaVideo, InputMediaAudio, InputMediaAnimation)
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
-from telegram.error import TelegramError
+from telegram.error import TelegramError, Forbidden, BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
 import threading
 from flask import Flask, request
+from werkzeug.serving import make_server
 import signal
 import sys
+import multiprocessing
 
 # Configure logging
 logging.basicConfig(
@@ -25,283 +45,2455 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "8071576925:AAGgx_Jkuu-mRpjdMKiOQCDkkVQskXQYhQo")
 ADMIN_ID = int(os.environ.get("ADMIN_ID", "7251748706"))
 PIXABAY_API_KEY = os.environ.get("PIXABAY_API_KEY", "51444506-bffefcaf12816bd85a20222d1")
-PIXABAY_API_URL = "https://pixabay.com/api/"
+PIXABAY_API_URL = os.environ.get("PIXABAY_API_URL", "https://pixabay.com/api/")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+PIXABAY_TIMEOUT = float(os.environ.get("PIXABAY_TIMEOUT", "10"))
+PIXABAY_MAX_CONNECTIONS = int(os.environ.get("PIXABAY_MAX_CONNECTIONS", "20"))
+
+# Pixabay quota scheduling; PIXABAY_API_KEYS is a comma-separated pool of keys
+PIXABAY_API_KEYS = [key.strip() for key in os.environ.get("PIXABAY_API_KEYS", PIXABAY_API_KEY).split(",") if key.strip()]
+PIXABAY_QUOTA_LOW_WATERMARK = int(os.environ.get("PIXABAY_QUOTA_LOW_WATERMARK", "10"))
+PIXABAY_MAX_QUEUE_WAIT = float(os.environ.get("PIXABAY_MAX_QUEUE_WAIT", "5"))
+PRIORITY_INTERACTIVE = 0
+PRIORITY_PREFETCH = 1
+
+# Pixabay result cache
+PIXABAY_CACHE_TTL = float(os.environ.get("PIXABAY_CACHE_TTL", "900"))
+PIXABAY_CACHE_MAX_ENTRIES = int(os.environ.get("PIXABAY_CACHE_MAX_ENTRIES", "1000"))
+PIXABAY_CACHE_MAX_BYTES = int(os.environ.get("PIXABAY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+PIXABAY_CACHE_PATH = os.environ.get("PIXABAY_CACHE_PATH", "")
+
+# Optional JSON file mapping Arabic search terms to English
+QUERY_DICTIONARY_PATH = os.environ.get("QUERY_DICTIONARY_PATH", "")
+
+# In-memory user sessions
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "5000"))
+SESSION_IDLE_TTL = float(os.environ.get("SESSION_IDLE_TTL", "1800"))
+SESSION_FLUSH_INTERVAL = float(os.environ.get("SESSION_FLUSH_INTERVAL", "2"))
+
+# Webhook update processing
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", "1000"))
+
+# Write-behind search accounting
+ACCOUNTING_FLUSH_INTERVAL_MS = int(os.environ.get("ACCOUNTING_FLUSH_INTERVAL_MS", "500"))
+ACCOUNTING_FLUSH_BATCH = int(os.environ.get("ACCOUNTING_FLUSH_BATCH", "200"))
+
+# Search history retention
+HISTORY_RETENTION_DAYS = int(os.environ.get("HISTORY_RETENTION_DAYS", "30"))
+ROLLUP_RETENTION_DAYS = int(os.environ.get("ROLLUP_RETENTION_DAYS", "400"))
+HISTORY_ARCHIVE_DIR = os.environ.get("HISTORY_ARCHIVE_DIR", "history_archive")
+HISTORY_MAINTENANCE_INTERVAL = float(os.environ.get("HISTORY_MAINTENANCE_INTERVAL", "3600"))
+
+# Mandatory subscription checks
+SUBSCRIPTION_POSITIVE_TTL = float(os.environ.get("SUBSCRIPTION_POSITIVE_TTL", "600"))
+SUBSCRIPTION_NEGATIVE_TTL = float(os.environ.get("SUBSCRIPTION_NEGATIVE_TTL", "30"))
+SUBSCRIPTION_CACHE_SIZE = int(os.environ.get("SUBSCRIPTION_CACHE_SIZE", "50000"))
+
+# Broadcasts
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", "500"))
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get("BROADCAST_PROGRESS_INTERVAL", "5"))
+BROADCAST_MAX_RETRIES = int(os.environ.get("BROADCAST_MAX_RETRIES", "3"))
+
+# Telegram file_id cache for Pixabay media
+MEDIA_CACHE_SIZE = int(os.environ.get("MEDIA_CACHE_SIZE", "20000"))
+
+# Prefetching of neighbouring results
+PREFETCH_CHAT_ID = os.environ.get("PREFETCH_CHAT_ID", "")
+PREFETCH_DISTANCE = int(os.environ.get("PREFETCH_DISTANCE", "1"))
+PREFETCH_CONCURRENCY = int(os.environ.get("PREFETCH_CONCURRENCY", "2"))
+# How long a URL check is trusted before the URL is checked again
+PREFETCH_URL_CHECK_TTL = float(os.environ.get("PREFETCH_URL_CHECK_TTL", "600"))
+
+# Paginated search results
+RESULTS_PER_PAGE = int(os.environ.get("RESULTS_PER_PAGE", "20"))
+RESULT_WINDOW_PAGES = int(os.environ.get("RESULT_WINDOW_PAGES", "3"))
+RESULT_PAGE_PREFETCH_MARGIN = int(os.environ.get("RESULT_PAGE_PREFETCH_MARGIN", "5"))
+
+# Navigation tokens in callback_data
+SEARCH_TYPE_CODES = ("photo", "illustration", "vector", "video", "music", "gif")
+NAV_TOKEN_SECRET = (os.environ.get("NAV_TOKEN_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()).encode()
+NAV_CURSOR_CACHE_SIZE = int(os.environ.get("NAV_CURSOR_CACHE_SIZE", "1000"))
+
+# SQLite tuning
+DB_PATH = os.environ.get("DB_PATH", "bot_database.db")
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHED_STATEMENTS = int(os.environ.get("DB_CACHED_STATEMENTS", "128"))
+# Rebuild an existing database at startup to enable incremental auto-vacuum; the VACUUM delays readiness
+DB_INCREMENTAL_VACUUM = os.environ.get("DB_INCREMENTAL_VACUUM", "") == "1"
+
+# Update ingestion: "webhook" or "polling"; must be set outside Render, where it defaults to webhook
+UPDATE_MODE = os.environ.get("UPDATE_MODE", "").lower()
+POLL_TIMEOUT = int(os.environ.get("POLL_TIMEOUT", "30"))
+POLL_LIMIT = int(os.environ.get("POLL_LIMIT", "100"))
+
+# Multi-process update handling; updates are routed to UPDATE_SHARDS worker processes by user
+UPDATE_SHARDS = int(os.environ.get("UPDATE_SHARDS", "1"))
+SHARD_QUEUE_SIZE = int(os.environ.get("SHARD_QUEUE_SIZE", "1000"))
+SHARD_SYNC_INTERVAL = float(os.environ.get("SHARD_SYNC_INTERVAL", "2"))
+SHARD_STATS_FIELDS = ("received", "queue_depth", "active", "processed", "failed", "shed", "ready")
+
+# update_id de-duplication of webhook retries
+UPDATE_DEDUP_WINDOW = int(os.environ.get("UPDATE_DEDUP_WINDOW", "4096"))
+UPDATE_DEDUP_PERSIST_INTERVAL = float(os.environ.get("UPDATE_DEDUP_PERSIST_INTERVAL", "1"))
+
+# Webhook registration
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "https://telegram-oihp.onrender.com/webhook")
+WEBHOOK_ALLOWED_UPDATES = ["message", "callback_query"]
+
+class StartupProgress:
+    """Times the startup phases and reports when the bot is ready for updates"""
+    
+    def __init__(self):
+        self.began = time.perf_counter()
+        self.phases: List[tuple] = []
+        self.ready = threading.Event()
+        self.failed: Optional[str] = None
+    
+    def record(self, name: str, seconds: float):
+        self.phases.append((name, seconds))
+    
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Time the enclosed block as one startup phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+    
+    def mark_ready(self):
+        self.ready.set()
+        breakdown = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.phases)
+        logger.info(f"⏱️ Ready in {(time.perf_counter() - self.began) * 1000:.0f}ms ({breakdown})")
+    
+    def summary(self) -> Dict:
+        return {
+            "ready": self.ready.is_set(),
+            "failed": self.failed,
+            "uptime_ms": round((time.perf_counter() - self.began) * 1000, 1),
+            "phases_ms": {name: round(seconds * 1000, 1) for name, seconds in self.phases}
+        }
+
+# Initialize startup tracking
+startup = StartupProgress()
+
+class LazyComponent:
+    """Builds a component on first use and forwards attribute access to it"""
+    
+    def __init__(self, factory):
+        self._lazy_factory = factory
+        self._lazy_instance = None
+        self._lazy_lock = threading.Lock()
+    
+    def _lazy_resolve(self):
+        instance = self._lazy_instance
+        if instance is None:
+            with self._lazy_lock:
+                if self._lazy_instance is None:
+                    self._lazy_instance = self._lazy_factory()
+                instance = self._lazy_instance
+        return instance
+    
+    def __getattr__(self, name: str):
+        return getattr(self._lazy_resolve(), name)
+
+# Bot API connections and metrics
+BOT_API_POOL_SIZE = int(os.environ.get("BOT_API_POOL_SIZE", "16"))
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_CALLBACK_PREFIXES = frozenset(("verify", "start", "search", "set", "back", "nav", "sel", "select", "admin", "add", "remove"))
+METRICS_COMMANDS = frozenset(("start", "admin"))
+
+# Per-update tracing
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_SLOW_UPDATES = int(os.environ.get("TRACE_SLOW_UPDATES", "20"))
+TRACE_MAX_SPANS = int(os.environ.get("TRACE_MAX_SPANS", "200"))
+
+class Metrics:
+    """Prometheus-style registry of counters, latency histograms and scrape-time gauges"""
+    
+    def __init__(self, buckets: tuple = METRICS_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # Metric name -> (type, help text)
+        self._descriptions: Dict[str, tuple] = {}
+        # (name, labels) -> value, where labels is a tuple of (label, value) pairs
+        self._counters: Dict[tuple, float] = {}
+        # (name, labels) -> [per-bucket counts, sum, count]
+        self._histograms: Dict[tuple, list] = {}
+        # Metric name -> callable returning the current value
+        self._gauges: Dict[str, Any] = {}
+        # Extra labels -> snapshot() taken in another process, such as an update shard
+        self._remote: Dict[tuple, Dict] = {}
+        self._lock = threading.Lock()
+    
+    def describe(self, name: str, kind: str, help_text: str):
+        """Set the type and help text reported for a metric"""
+        self._descriptions[name] = (kind, help_text)
+    
+    def gauge(self, name: str, help_text: str, callback, kind: str = "gauge"):
+        """Register a value, or a dict of label tuples to values, read from callback at scrape time"""
+        self.describe(name, kind, help_text)
+        self._gauges[name] = callback
+    
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        """Increment a counter"""
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def observe(self, name: str, value: float, labels: tuple = ()):
+        """Record one observation in a histogram"""
+        index = bisect.bisect_left(self.buckets, value)
+        key = (name, labels)
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+    
+    def total(self, name: str) -> tuple:
+        """Get the (sum, count) of a histogram across all of its label sets"""
+        with self._lock:
+            entries = [entry for (metric, _), entry in self._histograms.items() if metric == name]
+            return sum(entry[1] for entry in entries), sum(entry[2] for entry in entries)
+    
+    @staticmethod
+    def _format_labels(labels: tuple) -> str:
+        if not labels:
+            return ""
+        pairs = []
+        for name, value in labels:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            pairs.append(f'{name}="{value}"')
+        return "{" + ",".join(pairs) + "}"
+    
+    def snapshot(self) -> Dict:
+        """Get the current value of every series as plain data that can be sent to another process"""
+        with self._lock:
+            counters = [(name, labels, value) for (name, labels), value in self._counters.items()]
+            histograms = [(name, labels, list(entry[0]), entry[1], entry[2])
+                          for (name, labels), entry in self._histograms.items()]
+        
+        gauges = []
+        for name, callback in self._gauges.items():
+            try:
+                value = callback()
+                # Callbacks may return {labels: value} for labelled series
+                if isinstance(value, dict):
+                    gauges.extend((name, labels, v) for labels, v in value.items())
+                else:
+                    gauges.append((name, (), value))
+            except Exception as e:
+                logger.error(f"Error reading metric {name}: {e}")
+        return {"counters": counters, "histograms": histograms, "gauges": gauges}
+    
+    def set_remote(self, labels: tuple, snapshot: Dict):
+        """Render another process's snapshot along with the local series, adding labels to each of them"""
+        with self._lock:
+            self._remote[labels] = snapshot
+    
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format"""
+        sources = [((), self.snapshot())]
+        with self._lock:
+            sources.extend(self._remote.items())
+        
+        samples: Dict[str, List[str]] = {}
+        for extra, snapshot in sources:
+            for name, labels, value in snapshot["counters"] + snapshot["gauges"]:
+                samples.setdefault(name, []).append(f"{name}{self._format_labels(extra + labels)} {value}")
+            for name, labels, counts, total, count in snapshot["histograms"]:
+                labels = extra + labels
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{self._format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        
+        output = []
+        for name in sorted(samples):
+            kind, help_text = self._descriptions.get(name, ("untyped", ""))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(samples[name])
+        return "\n".join(output) + "\n"
+
+# Initialize metrics
+metrics = Metrics()
+metrics.describe("bot_update_seconds", "histogram", "Time to process one update, by handler and callback prefix")
+metrics.describe("bot_db_query_seconds", "histogram", "Latency of database methods")
+metrics.describe("pixabay_request_seconds", "histogram", "Latency of Pixabay API requests, by HTTP status")
+metrics.describe("pixabay_quota_rejections_total", "counter", "Pixabay searches refused because every key was out of quota")
+metrics.describe("telegram_api_request_seconds", "histogram", "Latency of Bot API calls, by method and HTTP status or error")
+
+# Trace of the update being processed in the current task, if it was sampled
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("current_trace", default=None)
+
+class Tracer:
+    """Samples updates, records their DB, Pixabay and Bot API spans and keeps the slowest ones"""
+    
+    def __init__(self, sample_rate: float = TRACE_SAMPLE_RATE, slow_size: int = TRACE_SLOW_UPDATES,
+                 max_spans: int = TRACE_MAX_SPANS):
+        self.sample_rate = sample_rate
+        self.slow_size = slow_size
+        self.max_spans = max_spans
+        # Min-heap of (duration, sequence, trace) holding the slowest finished traces
+        self._slowest: List[tuple] = []
+        self._sequence = 0
+        # Source name -> slowest() of another process, such as an update shard
+        self._remote: Dict[str, List[Dict]] = {}
+        self._lock = threading.Lock()
+        self.sampled = 0
+    
+    def start(self, update_id: Optional[int], route: tuple) -> Optional[tuple]:
+        """Begin tracing an update if it is sampled, returning a handle for finish()"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        trace = {
+            "update_id": update_id,
+            "route": dict(route),
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "spans": [],
+            "dropped_spans": 0,
+            "_start": time.perf_counter()
+        }
+        return trace, _current_trace.set(trace)
+    
+    def span(self, kind: str, name: str, start: float, duration: float):
+        """Attach a finished span to the current trace, if any"""
+        trace = _current_trace.get()
+        # Background tasks spawned by an update can outlive its trace
+        if trace is None or "duration_ms" in trace:
+            return
+        if len(trace["spans"]) >= self.max_spans:
+            trace["dropped_spans"] += 1
+            return
+        trace["spans"].append((kind, name, round((start - trace["_start"]) * 1000, 2), round(duration * 1000, 2)))
+    
+    def finish(self, handle: tuple, outcome: str):
+        """Close a trace and keep it if it is among the slowest"""
+        trace, token = handle
+        _current_trace.reset(token)
+        duration = time.perf_counter() - trace["_start"]
+        breakdown: Dict[str, float] = {}
+        for kind, _, _, duration_ms in trace["spans"]:
+            breakdown[kind] = breakdown.get(kind, 0) + duration_ms
+        trace["breakdown"] = {kind: round(total, 2) for kind, total in breakdown.items()}
+        trace["outcome"] = outcome
+        trace["duration_ms"] = round(duration * 1000, 2)
+        
+        with self._lock:
+            self.sampled += 1
+            self._sequence += 1
+            entry = (duration, self._sequence, trace)
+            if len(self._slowest) < self.slow_size:
+                heapq.heappush(self._slowest, entry)
+            elif self._slowest and duration > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+    
+    def slowest(self, limit: int = None) -> List[Dict]:
+        """Get the slowest traces, slowest first, including those reported by other processes"""
+        with self._lock:
+            entries = sorted(self._slowest, reverse=True)[:limit]
+            remote = [trace for traces in self._remote.values() for trace in traces]
+        traces = [{key: value for key, value in trace.items() if key != "_start"} for _, _, trace in entries]
+        if remote:
+            traces = sorted(traces + remote, key=lambda trace: trace["duration_ms"], reverse=True)[:limit]
+        return traces
+    
+    def set_remote(self, source: str, traces: List[Dict]):
+        """Include another process's slowest traces in slowest()"""
+        with self._lock:
+            self._remote[source] = traces
+
+# Initialize tracer
+tracer = Tracer()
+
+def db_timed(method):
+    """Record the latency of a Database method"""
+    name = method.__name__
+    labels = (("method", name),)
+    
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe("bot_db_query_seconds", elapsed, labels)
+            tracer.span("db", name, start, elapsed)
+    return wrapper
 
 # Database setup
 class Database:
-    def __init__(self, db_name='bot_database.db'):
+    def __init__(self, db_name: str = DB_PATH, busy_timeout_ms: int = DB_BUSY_TIMEOUT_MS,
+                 cached_statements: int = DB_CACHED_STATEMENTS):
         self.db_name = db_name
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        # One long-lived connection per thread, keyed by thread ident
+        self._connections: Dict[int, tuple] = {}
+        self._connections_lock = threading.Lock()
         self.init_database()
+        # Banned user IDs, replaced wholesale on change so reads need no lock
+        self.reload_banned_ids()
+    
+    def _open_connection(self) -> sqlite3.Connection:
+        """Open a new connection configured for concurrent access"""
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=self.busy_timeout_ms / 1000,
+            cached_statements=self.cached_statements,
+            check_same_thread=False
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+    
+    def get_connection(self) -> sqlite3.Connection:
+        """Get the calling thread's pooled connection, opening it on first use"""
+        thread = threading.current_thread()
+        entry = self._connections.get(thread.ident)
+        if entry is not None and entry[0] is thread:
+            return entry[1]
+        
+        conn = self._open_connection()
+        with self._connections_lock:
+            # Release connections owned by threads that have exited
+            for ident, (owner, stale_conn) in list(self._connections.items()):
+                if not owner.is_alive():
+                    stale_conn.close()
+                    del self._connections[ident]
+            self._connections[thread.ident] = (thread, conn)
+        return conn
+    
+    def close(self):
+        """Close every pooled connection"""
+        with self._connections_lock:
+            for owner, conn in self._connections.values():
+                try:
+                    conn.close()
+                except sqlite3.Error as e:
+                    logger.warning(f"Failed to close database connection: {e}")
+            self._connections.clear()
     
     def init_database(self):
         """Initialize database tables"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
+        conn = self.get_connection()
+        self.enable_incremental_vacuum(rebuild=False)
         
-        # Users table
+        with conn:
+            cursor = conn.cursor()
+            
+            # Users table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    first_name TEXT,
+                    last_name TEXT,
+                    join_date TEXT,
+                    is_banned INTEGER DEFAULT 0,
+                    search_count INTEGER DEFAULT 0
+                )
+            ''')
+            
+            # Mandatory channels table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS mandatory_channels (
+                    channel_id TEXT PRIMARY KEY,
+                    channel_username TEXT,
+                    added_by INTEGER,
+                    added_date TEXT
+                )
+            ''')
+            
+            # Search history table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS search_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    query TEXT,
+                    search_type TEXT,
+                    timestamp TEXT,
+                    results_count INTEGER
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_search_history_user_time ON search_history (user_id, timestamp)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_search_history_time ON search_history (timestamp)')
+            
+            # Broadcast jobs, checkpointed so they can resume after a restart
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    admin_id INTEGER,
+                    chat_id INTEGER,
+                    progress_message_id INTEGER,
+                    text TEXT,
+                    status TEXT,
+                    last_user_id INTEGER DEFAULT 0,
+                    sent INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    blocked INTEGER DEFAULT 0,
+                    created_at TEXT,
+                    updated_at TEXT
+                )
+            ''')
+            
+            # Telegram file_ids of Pixabay media that has already been uploaded
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS media_cache (
+                    hit_id TEXT,
+                    kind TEXT,
+                    rendition TEXT,
+                    file_id TEXT,
+                    last_used REAL,
+                    PRIMARY KEY (hit_id, kind, rendition)
+                )
+            ''')
+            
+            # Users who blocked the bot are skipped by broadcasts
+            columns = [row[1] for row in cursor.execute('PRAGMA table_info(users)')]
+            if "is_blocked" not in columns:
+                cursor.execute('ALTER TABLE users ADD COLUMN is_blocked INTEGER DEFAULT 0')
+            
+            # User sessions table for managing search states
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_sessions (
+                    user_id INTEGER PRIMARY KEY,
+                    current_query TEXT,
+                    current_type TEXT,
+                    current_results TEXT,
+                    current_index INTEGER DEFAULT 0
+                )
+            ''')
+            
+            # Searches referenced by navigation tokens, so old messages keep working; session IDs are
+            # only 32 bits, so they are unique per user rather than globally
+            columns = {row[1]: row[5] for row in cursor.execute('PRAGMA table_info(search_sessions)')}
+            migrate_sessions = bool(columns) and not columns.get("user_id")
+            if migrate_sessions:
+                cursor.execute('DROP INDEX IF EXISTS idx_search_sessions_created')
+                cursor.execute('ALTER TABLE search_sessions RENAME TO search_sessions_old')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS search_sessions (
+                    session_id INTEGER,
+                    user_id INTEGER,
+                    query TEXT,
+                    search_type TEXT,
+                    total INTEGER,
+                    per_page INTEGER,
+                    created_at TEXT,
+                    PRIMARY KEY (user_id, session_id)
+                )
+            ''')
+            if migrate_sessions:
+                cursor.execute('''
+                    INSERT OR REPLACE INTO search_sessions
+                    (session_id, user_id, query, search_type, total, per_page, created_at)
+                    SELECT session_id, user_id, query, search_type, total, per_page, created_at FROM search_sessions_old
+                ''')
+                cursor.execute('DROP TABLE search_sessions_old')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_search_sessions_created ON search_sessions (created_at)')
+            
+            # Small persistent values such as the getUpdates offset
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bot_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            ''')
+            
+            self.init_statistics(cursor)
+    
+    def init_statistics(self, cursor: sqlite3.Cursor):
+        """Create the counters and rollup tables, kept current by triggers"""
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                join_date TEXT,
-                is_banned INTEGER DEFAULT 0,
-                search_count INTEGER DEFAULT 0
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER DEFAULT 0
             )
         ''')
         
-        # Mandatory channels table
+        # Searches per hour ("YYYY-MM-DDTHH") and type
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS mandatory_channels (
-                channel_id TEXT PRIMARY KEY,
-                channel_username TEXT,
-                added_by INTEGER,
-                added_date TEXT
+            CREATE TABLE IF NOT EXISTS search_stats_hourly (
+                bucket TEXT,
+                search_type TEXT,
+                searches INTEGER DEFAULT 0,
+                PRIMARY KEY (bucket, search_type)
             )
         ''')
         
-        # Search history table
+        # Searches per day ("YYYY-MM-DD") and normalized query
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS search_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
+            CREATE TABLE IF NOT EXISTS search_query_daily (
+                day TEXT,
                 query TEXT,
-                search_type TEXT,
-                timestamp TEXT,
-                results_count INTEGER
+                searches INTEGER DEFAULT 0,
+                PRIMARY KEY (day, query)
             )
         ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_search_query_daily_top ON search_query_daily (day, searches DESC)')
         
-        # User sessions table for managing search states
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_sessions (
-                user_id INTEGER PRIMARY KEY,
-                current_query TEXT,
-                current_type TEXT,
-                current_results TEXT,
-                current_index INTEGER DEFAULT 0
-            )
+            CREATE TRIGGER IF NOT EXISTS users_insert_stats AFTER INSERT ON users BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = 'total_users';
+                UPDATE counters SET value = value + NEW.search_count WHERE name = 'total_searches';
+                UPDATE counters SET value = value + NEW.is_banned WHERE name = 'banned_users';
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS users_delete_stats AFTER DELETE ON users BEGIN
+                UPDATE counters SET value = value - 1 WHERE name = 'total_users';
+                UPDATE counters SET value = value - OLD.search_count WHERE name = 'total_searches';
+                UPDATE counters SET value = value - OLD.is_banned WHERE name = 'banned_users';
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS users_update_stats AFTER UPDATE OF search_count, is_banned ON users BEGIN
+                UPDATE counters SET value = value + NEW.search_count - OLD.search_count WHERE name = 'total_searches';
+                UPDATE counters SET value = value + NEW.is_banned - OLD.is_banned WHERE name = 'banned_users';
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS search_history_rollup AFTER INSERT ON search_history BEGIN
+                INSERT INTO search_stats_hourly (bucket, search_type, searches)
+                VALUES (substr(NEW.timestamp, 1, 13), NEW.search_type, 1)
+                ON CONFLICT (bucket, search_type) DO UPDATE SET searches = searches + 1;
+                INSERT INTO search_query_daily (day, query, searches)
+                VALUES (substr(NEW.timestamp, 1, 10), lower(trim(NEW.query)), 1)
+                ON CONFLICT (day, query) DO UPDATE SET searches = searches + 1;
+            END
         ''')
         
-        conn.commit()
-        conn.close()
+        # First run on an existing database: compute everything once
+        if cursor.execute('SELECT COUNT(*) FROM counters').fetchone()[0] == 0:
+            cursor.execute('''
+                INSERT INTO counters (name, value)
+                SELECT 'total_users', COUNT(*) FROM users
+                UNION ALL SELECT 'total_searches', COALESCE(SUM(search_count), 0) FROM users
+                UNION ALL SELECT 'banned_users', COUNT(*) FROM users WHERE is_banned = 1
+            ''')
+            cursor.execute('''
+                INSERT OR REPLACE INTO search_stats_hourly (bucket, search_type, searches)
+                SELECT substr(timestamp, 1, 13), search_type, COUNT(*) FROM search_history
+                GROUP BY 1, 2
+            ''')
+            cursor.execute('''
+                INSERT OR REPLACE INTO search_query_daily (day, query, searches)
+                SELECT substr(timestamp, 1, 10), lower(trim(query)), COUNT(*) FROM search_history
+                GROUP BY 1, 2
+            ''')
     
+    @db_timed
     def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None):
         """Add or update user in database"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
+        conn = self.get_connection()
+        
+        # Upsert keeps search_count and the ban flag; a returning user is no longer blocked
+        with conn:
+            conn.execute('''
+                INSERT INTO users (user_id, username, first_name, last_name, join_date)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name,
+                    join_date = excluded.join_date,
+                    is_blocked = 0
+            ''', (user_id, username or "", first_name or "", last_name or "", datetime.now().isoformat()))
+    
+    @db_timed
+    def load_banned_user_ids(self) -> List[int]:
+        """Get the IDs of all banned users"""
+        conn = self.get_connection()
         
-        cursor.execute('''
-            INSERT OR REPLACE INTO users 
-            (user_id, username, first_name, last_name, join_date, search_count)
-            VALUES (?, ?, ?, ?, ?, COALESCE((SELECT search_count FROM users WHERE user_id = ?), 0))
-        ''', (user_id, username or "", first_name or "", last_name or "", datetime.now().isoformat(), user_id))
+        results = conn.execute('SELECT user_id FROM users WHERE is_banned = 1').fetchall()
         
-        conn.commit()
-        conn.close()
+        return [r[0] for r in results]
+    
+    def reload_banned_ids(self):
+        """Refresh the in-memory set of banned users"""
+        self._banned_ids = frozenset(self.load_banned_user_ids())
+    
+    def _touch_shared_state(self, conn: sqlite3.Connection):
+        """Record that bans or channels changed, so other worker processes reload them"""
+        conn.execute("INSERT OR REPLACE INTO bot_state (key, value) VALUES ('shared_version', ?)", (str(time.time_ns()),))
     
     def is_user_banned(self, user_id: int) -> bool:
         """Check if user is banned"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT is_banned FROM users WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        
-        conn.close()
-        return result and result[0] == 1
+        return user_id in self._banned_ids
     
+    @db_timed
     def ban_user(self, user_id: int):
         """Ban a user"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('UPDATE users SET is_banned = 1 WHERE user_id = ?', (user_id,))
-        
-        conn.commit()
-        conn.close()
+        conn = self.get_connection()
+        
+        # Create the row if needed so bans of users who never started the bot persist too
+        with conn:
+            conn.execute('''
+                INSERT INTO users (user_id, username, first_name, last_name, join_date, is_banned)
+                VALUES (?, '', '', '', ?, 1)
+                ON CONFLICT(user_id) DO UPDATE SET is_banned = 1
+            ''', (user_id, datetime.now().isoformat()))
+            self._touch_shared_state(conn)
+        self._banned_ids = self._banned_ids | {user_id}
     
+    @db_timed
     def unban_user(self, user_id: int):
         """Unban a user"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('UPDATE users SET is_banned = 0 WHERE user_id = ?', (user_id,))
+        conn = self.get_connection()
         
-        conn.commit()
-        conn.close()
+        with conn:
+            conn.execute('UPDATE users SET is_banned = 0 WHERE user_id = ?', (user_id,))
+            self._touch_shared_state(conn)
+        self._banned_ids = self._banned_ids - {user_id}
     
+    @db_timed
     def add_mandatory_channel(self, channel_id: str, channel_username: str, added_by: int):
         """Add mandatory channel"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO mandatory_channels 
-            (channel_id, channel_username, added_by, added_date)
-            VALUES (?, ?, ?, ?)
-        ''', (channel_id, channel_username, added_by, datetime.now().isoformat()))
-        
-        conn.commit()
-        conn.close()
+        conn = self.get_connection()
+        
+        with conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO mandatory_channels 
+                (channel_id, channel_username, added_by, added_date)
+                VALUES (?, ?, ?, ?)
+            ''', (channel_id, channel_username, added_by, datetime.now().isoformat()))
+            self._touch_shared_state(conn)
     
+    @db_timed
     def remove_mandatory_channel(self, channel_id: str):
         """Remove mandatory channel"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
+        conn = self.get_connection()
         
-        cursor.execute('DELETE FROM mandatory_channels WHERE channel_id = ?', (channel_id,))
-        
-        conn.commit()
-        conn.close()
+        with conn:
+            conn.execute('DELETE FROM mandatory_channels WHERE channel_id = ?', (channel_id,))
+            self._touch_shared_state(conn)
     
+    @db_timed
     def get_mandatory_channels(self) -> List[Dict]:
         """Get all mandatory channels"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
+        conn = self.get_connection()
         
-        cursor.execute('SELECT channel_id, channel_username FROM mandatory_channels')
-        results = cursor.fetchall()
+        results = conn.execute('SELECT channel_id, channel_username FROM mandatory_channels').fetchall()
         
-        conn.close()
         return [{"id": r[0], "username": r[1]} for r in results]
     
-    def increment_search_count(self, user_id: int):
-        """Increment user's search count"""
-        conn = sqlite3.connect(self.db_name)
+    @db_timed
+    def record_searches(self, searches: List[tuple]):
+        """Apply a batch of (user_id, query, search_type, timestamp, results_count) searches in one transaction"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.executemany('UPDATE users SET search_count = search_count + 1 WHERE user_id = ?',
+                             [(s[0],) for s in searches])
+            conn.executemany('''
+                INSERT INTO search_history (user_id, query, search_type, timestamp, results_count)
+                VALUES (?, ?, ?, ?, ?)
+            ''', searches)
+    
+    @db_timed
+    def get_statistics(self, top_queries: int = 5) -> Dict:
+        """Get bot statistics from the precomputed counters and rollups"""
+        conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('UPDATE users SET search_count = search_count + 1 WHERE user_id = ?', (user_id,))
+        counters = dict(cursor.execute('SELECT name, value FROM counters').fetchall())
+        
+        # Mandatory channels count
+        cursor.execute('SELECT COUNT(*) FROM mandatory_channels')
+        mandatory_channels_count = cursor.fetchone()[0]
+        
+        now = datetime.now().isoformat()
+        hour, day = now[:13], now[:10]
+        
+        cursor.execute('SELECT COALESCE(SUM(searches), 0) FROM search_stats_hourly WHERE bucket = ?', (hour,))
+        searches_this_hour = cursor.fetchone()[0]
         
-        conn.commit()
-        conn.close()
+        # Range over today's hourly buckets ("YYYY-MM-DDTHH" sorts below "YYYY-MM-DDU")
+        cursor.execute('''
+            SELECT search_type, SUM(searches) FROM search_stats_hourly
+            WHERE bucket >= ? AND bucket < ?
+            GROUP BY search_type ORDER BY 2 DESC
+        ''', (day, day + "U"))
+        searches_today_by_type = dict(cursor.fetchall())
+        
+        cursor.execute('''
+            SELECT query, searches FROM search_query_daily
+            WHERE day = ? ORDER BY searches DESC LIMIT ?
+        ''', (day, top_queries))
+        top_queries_today = cursor.fetchall()
+        
+        return {
+            "total_users": counters.get("total_users", 0),
+            "total_searches": counters.get("total_searches", 0),
+            "mandatory_channels": mandatory_channels_count,
+            "banned_users": counters.get("banned_users", 0),
+            "searches_this_hour": searches_this_hour,
+            "searches_today": sum(searches_today_by_type.values()),
+            "searches_today_by_type": searches_today_by_type,
+            "top_queries_today": top_queries_today
+        }
+    
+    @db_timed
+    def get_broadcast_recipients(self, after_user_id: int, limit: int) -> List[int]:
+        """Get the next page of broadcast recipients after a user ID"""
+        conn = self.get_connection()
+        
+        results = conn.execute('''
+            SELECT user_id FROM users
+            WHERE is_banned = 0 AND is_blocked = 0 AND user_id > ?
+            ORDER BY user_id
+            LIMIT ?
+        ''', (after_user_id, limit)).fetchall()
+        
+        return [r[0] for r in results]
+    
+    @db_timed
+    def mark_users_blocked(self, user_ids: List[int]):
+        """Flag users who blocked the bot so broadcasts skip them"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.executemany('UPDATE users SET is_blocked = 1 WHERE user_id = ?', [(uid,) for uid in user_ids])
+    
+    @db_timed
+    def create_broadcast(self, admin_id: int, chat_id: int, text: str) -> int:
+        """Create a broadcast job and return its ID"""
+        conn = self.get_connection()
+        now = datetime.now().isoformat()
+        
+        with conn:
+            cursor = conn.execute('''
+                INSERT INTO broadcasts (admin_id, chat_id, text, status, created_at, updated_at)
+                VALUES (?, ?, ?, 'running', ?, ?)
+            ''', (admin_id, chat_id, text, now, now))
+        
+        return cursor.lastrowid
+    
+    @db_timed
+    def set_broadcast_progress_message(self, job_id: int, message_id: int):
+        """Remember the admin message used to report a broadcast's progress"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.execute('UPDATE broadcasts SET progress_message_id = ? WHERE id = ?', (message_id, job_id))
+    
+    @db_timed
+    def update_broadcast(self, job_id: int, status: str, last_user_id: int, sent: int, failed: int, blocked: int):
+        """Checkpoint a broadcast job's progress"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.execute('''
+                UPDATE broadcasts
+                SET status = ?, last_user_id = ?, sent = ?, failed = ?, blocked = ?, updated_at = ?
+                WHERE id = ?
+            ''', (status, last_user_id, sent, failed, blocked, datetime.now().isoformat(), job_id))
+    
+    @db_timed
+    def get_unfinished_broadcasts(self) -> List[Dict]:
+        """Get broadcast jobs that were interrupted before finishing"""
+        conn = self.get_connection()
+        
+        results = conn.execute('''
+            SELECT id, chat_id, progress_message_id, text, last_user_id, sent, failed, blocked
+            FROM broadcasts WHERE status = 'running' ORDER BY id
+        ''').fetchall()
+        
+        return [
+            {
+                "id": r[0],
+                "chat_id": r[1],
+                "progress_message_id": r[2],
+                "text": r[3],
+                "last_user_id": r[4],
+                "sent": r[5],
+                "failed": r[6],
+                "blocked": r[7]
+            }
+            for r in results
+        ]
+    
+    @db_timed
+    def get_media_file_ids(self, limit: int) -> List[tuple]:
+        """Get the most recently cached ((hit_id, kind, rendition), file_id) pairs, oldest first"""
+        conn = self.get_connection()
+        
+        rows = conn.execute('''
+            SELECT hit_id, kind, rendition, file_id FROM (
+                SELECT * FROM media_cache ORDER BY last_used DESC LIMIT ?
+            ) ORDER BY last_used
+        ''', (limit,)).fetchall()
+        
+        return [((r[0], r[1], r[2]), r[3]) for r in rows]
+    
+    @db_timed
+    def write_media_file_ids(self, changes: List[tuple], max_entries: int):
+        """Apply a batch of ((hit_id, kind, rendition), file_id) changes, None deleting, and prune the table"""
+        conn = self.get_connection()
+        now = time.time()
+        
+        with conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO media_cache (hit_id, kind, rendition, file_id, last_used)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(*key, file_id, now) for key, file_id in changes if file_id is not None])
+            conn.executemany('DELETE FROM media_cache WHERE hit_id = ? AND kind = ? AND rendition = ?',
+                             [key for key, file_id in changes if file_id is None])
+            # Keep only the most recently cached file_ids
+            if conn.execute('SELECT COUNT(*) FROM media_cache').fetchone()[0] > max_entries:
+                conn.execute('''
+                    DELETE FROM media_cache WHERE rowid IN (
+                        SELECT rowid FROM media_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                    )
+                ''', (max_entries,))
+    
+    @db_timed
+    def enable_incremental_vacuum(self, rebuild: bool = True):
+        """Switch the database file to incremental auto-vacuum
+        
+        A new database switches instantly; an existing one needs a full VACUUM that locks the file,
+        so it is only rebuilt when asked to.
+        """
+        conn = self.get_connection()
+        
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            return
+        empty = conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()[0] == 0
+        if not empty:
+            if not rebuild:
+                logger.info("Incremental auto-vacuum is off; set DB_INCREMENTAL_VACUUM=1 to rebuild the database once")
+                return
+            logger.info("Enabling incremental auto-vacuum (one-time VACUUM)")
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    
+    @db_timed
+    def get_expired_history(self, cutoff: str, limit: int) -> List[tuple]:
+        """Get the oldest search history rows recorded before a cutoff timestamp"""
+        conn = self.get_connection()
+        
+        return conn.execute('''
+            SELECT id, user_id, query, search_type, timestamp, results_count FROM search_history
+            WHERE timestamp < ? ORDER BY timestamp, id LIMIT ?
+        ''', (cutoff, limit)).fetchall()
+    
+    @db_timed
+    def delete_history(self, row_ids: List[int]):
+        """Delete archived search history rows"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.executemany('DELETE FROM search_history WHERE id = ?', [(row_id,) for row_id in row_ids])
+    
+    @db_timed
+    def prune_rollups(self, cutoff_day: str):
+        """Drop hourly and daily rollups and search sessions older than a day ("YYYY-MM-DD")"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.execute('DELETE FROM search_stats_hourly WHERE bucket < ?', (cutoff_day,))
+            conn.execute('DELETE FROM search_query_daily WHERE day < ?', (cutoff_day,))
+            conn.execute('DELETE FROM search_sessions WHERE created_at < ?', (cutoff_day,))
+    
+    @db_timed
+    def incremental_vacuum(self, pages: int):
+        """Return up to a number of free pages to the filesystem"""
+        conn = self.get_connection()
+        
+        conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+    
+    @db_timed
+    def save_user_sessions(self, sessions: List[tuple], indexes: List[tuple], search_sessions: List[tuple] = ()):
+        """Persist full sessions, index-only updates and search sessions in a single transaction"""
+        conn = self.get_connection()
+        
+        with conn:
+            if search_sessions:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO search_sessions
+                    (session_id, user_id, query, search_type, total, per_page, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', search_sessions)
+            if sessions:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO user_sessions 
+                    (user_id, current_query, current_type, current_results, current_index)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', sessions)
+            if indexes:
+                conn.executemany('UPDATE user_sessions SET current_index = ? WHERE user_id = ?', indexes)
+    
+    @db_timed
+    def get_search_session(self, session_id: int, user_id: int) -> Optional[Dict]:
+        """Get the query behind one of a user's searches"""
+        conn = self.get_connection()
+        
+        result = conn.execute(
+            'SELECT query, search_type, total, per_page FROM search_sessions WHERE session_id = ? AND user_id = ?',
+            (session_id, user_id)
+        ).fetchone()
+        
+        if result:
+            return {
+                "query": result[0],
+                "type": result[1],
+                "total": result[2],
+                "per_page": result[3]
+            }
+        return None
+    
+    @db_timed
+    def get_user_session(self, user_id: int) -> Optional[Dict]:
+        """Get user session data"""
+        conn = self.get_connection()
+        
+        result = conn.execute(
+            'SELECT current_query, current_type, current_results, current_index FROM user_sessions WHERE user_id = ?',
+            (user_id,)
+        ).fetchone()
+        
+        if result:
+            return {
+                "query": result[0],
+                "type": result[1],
+                "results": result[2],
+                "index": result[3]
+            }
+        return None
+    
+    @db_timed
+    def get_state(self, key: str) -> Optional[str]:
+        """Get a persistent bot state value"""
+        conn = self.get_connection()
+        
+        result = conn.execute('SELECT value FROM bot_state WHERE key = ?', (key,)).fetchone()
+        return result[0] if result else None
+    
+    @db_timed
+    def set_state(self, key: str, value: str):
+        """Store a persistent bot state value"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO bot_state (key, value) VALUES (?, ?)', (key, value))
+
+# Initialize database on first use; the schema setup is part of startup, not import
+db = LazyComponent(Database)
+
+class ResultCursor:
+    """Paginated view over a search's Pixabay hits, keeping a sliding window of pages"""
+    
+    def __init__(self, query: str, search_type: str, total: int = 0, per_page: int = RESULTS_PER_PAGE,
+                 window_pages: int = RESULT_WINDOW_PAGES, session_id: int = None):
+        # Identifies this search in navigation tokens
+        self.session_id = session_id if session_id is not None else secrets.randbits(32)
+        self.query = query
+        self.search_type = search_type
+        self.total = total
+        self.per_page = per_page
+        self.window_pages = window_pages
+        self.position = 0
+        # page number -> hits
+        self.pages: Dict[int, List[Dict]] = {}
+        self._loading: Dict[int, asyncio.Task] = {}
+    
+    @classmethod
+    def from_response(cls, query: str, search_type: str, response: Dict, per_page: int = RESULTS_PER_PAGE) -> "ResultCursor":
+        """Build a cursor from the first page of a search"""
+        cursor = cls(query, search_type, per_page=per_page)
+        cursor._add_page(1, response)
+        return cursor
+    
+    @classmethod
+    def from_json(cls, data: str, query: str, search_type: str) -> Optional["ResultCursor"]:
+        """Restore a cursor saved with to_json"""
+        if not data:
+            return None
+        state = json.loads(data)
+        if isinstance(state, list):
+            # Sessions saved before pagination hold a plain list of hits
+            cursor = cls(query, search_type, total=len(state), per_page=max(len(state), 1))
+            cursor.pages[1] = state
+            return cursor
+        cursor = cls(query, search_type, total=state["total"], per_page=state["per_page"],
+                     session_id=state.get("session_id"))
+        cursor.position = state.get("position", 0)
+        cursor.pages = {int(page): hits for page, hits in state["pages"].items()}
+        return cursor
+    
+    def to_json(self) -> str:
+        """Serialize the cursor for the sessions table"""
+        return json.dumps({
+            "session_id": self.session_id,
+            "total": self.total,
+            "per_page": self.per_page,
+            "position": self.position,
+            "pages": self.pages
+        })
+    
+    def __len__(self) -> int:
+        return self.total
+    
+    def __getitem__(self, index: int) -> Dict:
+        result = self.get(index)
+        if result is None:
+            raise IndexError(f"Result {index} is not loaded")
+        return result
+    
+    def page_of(self, index: int) -> int:
+        """Get the page number that holds an index"""
+        return index // self.per_page + 1
+    
+    def get(self, index: int) -> Optional[Dict]:
+        """Get a loaded result, or None if its page is not in the window"""
+        hits = self.pages.get(self.page_of(index))
+        offset = index % self.per_page
+        if hits is None or offset >= len(hits):
+            return None
+        return hits[offset]
+    
+    async def ensure(self, index: int) -> bool:
+        """Make sure the page holding an index is loaded and make it the current position"""
+        page = self.page_of(index)
+        if page not in self.pages and not await self._load(page):
+            return False
+        self.position = index
+        self._trim()
+        return self.get(index) is not None
+    
+    def prefetch(self, index: int):
+        """Start loading the next page early when an index gets close to the end of its page"""
+        page = self.page_of(index)
+        next_page = page + 1
+        if (index % self.per_page >= self.per_page - RESULT_PAGE_PREFETCH_MARGIN
+                and (next_page - 1) * self.per_page < self.total
+                and next_page not in self.pages and next_page not in self._loading):
+            asyncio.create_task(self._load(next_page, PRIORITY_PREFETCH))
+    
+    async def _load(self, page: int, priority: int = PRIORITY_INTERACTIVE) -> bool:
+        """Fetch a page, sharing the request with any load already in flight"""
+        task = self._loading.get(page)
+        if task is None:
+            task = asyncio.create_task(pixabay.search(self.query, self.search_type, self.per_page, page, priority))
+            self._loading[page] = task
+        try:
+            response = await asyncio.shield(task)
+        finally:
+            if task.done():
+                self._loading.pop(page, None)
+        
+        if "error" in response or not response.get("hits"):
+            logger.warning(f"Failed to load page {page} of '{self.query}'")
+            return False
+        # Trimming is left to ensure(), which knows the position the page was loaded for
+        self._add_page(page, response)
+        return True
+    
+    def _add_page(self, page: int, response: Dict):
+        """Store a page and update the known total"""
+        hits = response.get("hits", [])
+        self.pages[page] = hits
+        self.total = max(self.total, response.get("totalHits", response.get("total", 0)), (page - 1) * self.per_page + len(hits))
+        if len(hits) < self.per_page:
+            # A short page is the last one available
+            self.total = (page - 1) * self.per_page + len(hits)
+    
+    def _trim(self):
+        """Drop the pages farthest from the current position"""
+        current = self.page_of(self.position)
+        while len(self.pages) > self.window_pages:
+            farthest = max(self.pages, key=lambda page: abs(page - current))
+            del self.pages[farthest]
+
+def encode_nav_token(action: str, user_id: int, session_id: int, index: int, page: int, search_type: str) -> str:
+    """Pack a navigation target into signed callback_data ("<action>:<token>", well under 64 bytes)"""
+    type_code = SEARCH_TYPE_CODES.index(search_type) if search_type in SEARCH_TYPE_CODES else 0
+    payload = struct.pack(">IHIB", session_id, page, index, type_code)
+    # The user ID is signed but not sent, so a token only works for the user it was made for
+    signature = hmac.new(NAV_TOKEN_SECRET, payload + user_id.to_bytes(8, "big", signed=True), hashlib.sha256).digest()
+    return f"{action}:" + base64.urlsafe_b64encode(payload + signature[:8]).decode().rstrip("=")
+
+def decode_nav_token(data: str, user_id: int) -> Optional[Dict]:
+    """Unpack and verify callback_data built by encode_nav_token"""
+    try:
+        action, token = data.split(":", 1)
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        payload, signature = raw[:11], raw[11:]
+        expected = hmac.new(NAV_TOKEN_SECRET, payload + user_id.to_bytes(8, "big", signed=True), hashlib.sha256).digest()
+        if not hmac.compare_digest(signature, expected[:8]):
+            return None
+        session_id, page, index, type_code = struct.unpack(">IHIB", payload)
+        return {
+            "action": action,
+            "session_id": session_id,
+            "page": page,
+            "index": index,
+            "type": SEARCH_TYPE_CODES[type_code]
+        }
+    except (ValueError, IndexError, struct.error):
+        return None
+
+class SessionStore:
+    """In-memory user sessions with LRU/idle eviction and write-behind to SQLite"""
+    
+    def __init__(self, database: Database, max_sessions: int = SESSION_CACHE_SIZE,
+                 idle_ttl: float = SESSION_IDLE_TTL, flush_interval: float = SESSION_FLUSH_INTERVAL,
+                 max_cursors: int = NAV_CURSOR_CACHE_SIZE):
+        self.db = database
+        self.max_sessions = max_sessions
+        self.max_cursors = max_cursors
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        # user_id -> session dict, least recently used first
+        self._sessions: "OrderedDict[int, Dict]" = OrderedDict()
+        # user_id -> (full write?, session dict) waiting to be persisted
+        self._pending: Dict[int, tuple] = {}
+        # (user_id, session_id) -> cursor for navigation tokens, including older searches
+        self._cursors: "OrderedDict[tuple, ResultCursor]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._writer: Optional[threading.Thread] = None
+    
+    def get(self, user_id: int) -> Optional[Dict]:
+        """Get a user's session, loading it from the database on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is not None:
+                if now - session["accessed"] <= self.idle_ttl:
+                    session["accessed"] = now
+                    self._sessions.move_to_end(user_id)
+                    return session
+                del self._sessions[user_id]
+            pending = self._pending.get(user_id)
+            if pending is not None:
+                session = pending[1]
+                session["accessed"] = now
+                self._cache(user_id, session)
+                return session
+        
+        row = self.db.get_user_session(user_id)
+        if row is None:
+            return None
+        
+        session = {
+            "query": row["query"],
+            "type": row["type"],
+            "results": ResultCursor.from_json(row["results"], row["query"], row["type"]),
+            "index": row["index"],
+            "accessed": now
+        }
+        with self._lock:
+            # Another update may have created the session while we were reading
+            session = self._sessions.get(user_id) or self._cache(user_id, session)
+            if session["results"]:
+                self._register(user_id, session["results"])
+            return session
+    
+    def get_cursor(self, user_id: int, session_id: int) -> Optional[ResultCursor]:
+        """Get the results of one of a user's searches by session ID"""
+        key = (user_id, session_id)
+        with self._lock:
+            cached = self._cursors.get(key)
+            if cached is not None:
+                self._cursors.move_to_end(key)
+                return cached
+        
+        # Evicted or from before a restart: rebuild it, pages are reloaded on demand
+        row = self.db.get_search_session(session_id, user_id)
+        if row is None:
+            return None
+        cursor = ResultCursor(row["query"], row["type"], total=row["total"], per_page=row["per_page"],
+                              session_id=session_id)
+        with self._lock:
+            cached = self._cursors.get(key)
+            if cached is not None:
+                return cached
+            self._register(user_id, cursor)
+        return cursor
+    
+    def _register(self, user_id: int, cursor: ResultCursor):
+        """Remember a cursor by session ID, evicting the least recently used"""
+        key = (user_id, cursor.session_id)
+        self._cursors[key] = cursor
+        self._cursors.move_to_end(key)
+        while len(self._cursors) > self.max_cursors:
+            self._cursors.popitem(last=False)
+    
+    def set(self, user_id: int, query: str = None, search_type: str = None, results: ResultCursor = None, index: int = 0):
+        """Replace a user's session"""
+        session = {
+            "query": query or "",
+            "type": search_type or "",
+            "results": results,
+            "index": index,
+            "accessed": time.monotonic()
+        }
+        with self._lock:
+            self._cache(user_id, session)
+            self._pending[user_id] = (True, session)
+            if results:
+                self._register(user_id, results)
+    
+    def set_index(self, user_id: int, index: int, session_id: int = None):
+        """Move a user's session to another result in place"""
+        with self._lock:
+            pending = self._pending.get(user_id)
+            session = self._sessions.get(user_id) or (pending[1] if pending else None)
+            if session is None:
+                return
+            if session_id is not None and (not session["results"] or session["results"].session_id != session_id):
+                # Navigation in an older search's message
+                return
+            session["index"] = index
+            session["accessed"] = time.monotonic()
+            self._pending[user_id] = (pending is not None and pending[0], session)
+    
+    def _cache(self, user_id: int, session: Dict) -> Dict:
+        """Insert a session and evict idle or least recently used ones"""
+        self._sessions[user_id] = session
+        self._sessions.move_to_end(user_id)
+        
+        now = time.monotonic()
+        while self._sessions:
+            oldest_id, oldest = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and now - oldest["accessed"] <= self.idle_ttl:
+                break
+            # Unflushed sessions stay referenced from _pending until written
+            del self._sessions[oldest_id]
+        return session
+    
+    def flush(self):
+        """Write pending session changes to the database in one transaction"""
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            full_rows = []
+            index_rows = []
+            for user_id, (full, session) in pending.items():
+                if full:
+                    full_rows.append((user_id, session["query"], session["type"], session["results"], session["index"]))
+                else:
+                    index_rows.append((session["index"], user_id))
+        
+        now = datetime.now().isoformat()
+        try:
+            self.db.save_user_sessions(
+                [(uid, q, t, r.to_json() if r else "", i) for uid, q, t, r, i in full_rows],
+                index_rows,
+                [(r.session_id, uid, q, t, r.total, r.per_page, now) for uid, q, t, r, i in full_rows if r]
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Failed to flush user sessions: {e}")
+            with self._lock:
+                # Keep newer changes, re-queue the ones that failed
+                for user_id, entry in pending.items():
+                    self._pending.setdefault(user_id, entry)
+    
+    def _run_writer(self):
+        """Background loop flushing pending sessions"""
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+    
+    def start(self):
+        """Start the write-behind thread"""
+        if self._writer is None or not self._writer.is_alive():
+            self._stop_event.clear()
+            self._writer = threading.Thread(target=self._run_writer, name="session-writer", daemon=True)
+            self._writer.start()
+    
+    def stop(self):
+        """Stop the write-behind thread after a final flush"""
+        self._stop_event.set()
+        if self._writer is not None:
+            self._writer.join(timeout=10)
+            self._writer = None
+        else:
+            self.flush()
+
+# Initialize session store
+sessions = SessionStore(db)
+
+class AccountingWriter:
+    """Batches search accounting and media file_id writes and flushes them off the request path"""
+    
+    def __init__(self, database: Database, flush_interval_ms: int = ACCOUNTING_FLUSH_INTERVAL_MS,
+                 flush_batch: int = ACCOUNTING_FLUSH_BATCH, media_cache_size: int = MEDIA_CACHE_SIZE):
+        self.db = database
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_batch = flush_batch
+        self.media_cache_size = media_cache_size
+        self._searches: List[tuple] = []
+        # (hit_id, kind, rendition) -> file_id, or None to delete; later changes replace earlier ones
+        self._media: Dict[tuple, Optional[str]] = {}
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._writer: Optional[threading.Thread] = None
+    
+    def record_search(self, user_id: int, query: str, search_type: str, results_count: int):
+        """Queue a search for the user's count and the search history"""
+        with self._condition:
+            self._searches.append((user_id, query, search_type, datetime.now().isoformat(), results_count))
+            if len(self._searches) >= self.flush_batch:
+                self._condition.notify()
+    
+    def record_media_file_id(self, key: tuple, file_id: Optional[str]):
+        """Queue a file_id to store, or None to delete it"""
+        with self._condition:
+            self._media[key] = file_id
+    
+    def flush(self):
+        """Write all queued records in a single transaction"""
+        with self._condition:
+            searches, self._searches = self._searches, []
+            media, self._media = self._media, {}
+        
+        if searches:
+            try:
+                self.db.record_searches(searches)
+            except sqlite3.Error as e:
+                logger.error(f"Failed to flush {len(searches)} search records: {e}")
+                with self._condition:
+                    self._searches[:0] = searches
+        
+        if media:
+            try:
+                self.db.write_media_file_ids(list(media.items()), self.media_cache_size)
+            except sqlite3.Error as e:
+                logger.error(f"Failed to flush {len(media)} media file_ids: {e}")
+                with self._condition:
+                    # Changes queued since take precedence
+                    self._media = {**media, **self._media}
+    
+    def _run_writer(self):
+        """Background loop flushing every interval or whenever a batch fills up"""
+        while True:
+            with self._condition:
+                if not self._stopping and len(self._searches) < self.flush_batch:
+                    self._condition.wait(self.flush_interval)
+                stopping = self._stopping
+            self.flush()
+            if stopping:
+                return
+    
+    def start(self):
+        """Start the write-behind thread"""
+        if self._writer is None or not self._writer.is_alive():
+            self._stopping = False
+            self._writer = threading.Thread(target=self._run_writer, name="accounting-writer", daemon=True)
+            self._writer.start()
+    
+    def stop(self):
+        """Stop the write-behind thread after a final flush"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._writer is not None:
+            self._writer.join(timeout=10)
+            self._writer = None
+        self.flush()
+
+# Initialize accounting writer
+accounting = AccountingWriter(db)
+
+class HistoryRetention:
+    """Archives old search history to compressed segment files and compacts the database"""
+    
+    def __init__(self, database: Database, retention_days: int = HISTORY_RETENTION_DAYS,
+                 rollup_retention_days: int = ROLLUP_RETENTION_DAYS, archive_dir: str = HISTORY_ARCHIVE_DIR,
+                 interval: float = HISTORY_MAINTENANCE_INTERVAL, batch_size: int = 5000, vacuum_pages: int = 2000):
+        self.db = database
+        self.retention_days = retention_days
+        self.rollup_retention_days = rollup_retention_days
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    def run_once(self) -> int:
+        """Archive and delete expired history, prune old rollups and vacuum; returns rows archived"""
+        # Rollups are maintained by triggers as rows are written, so raw rows can go
+        cutoff = (datetime.now() - timedelta(days=self.retention_days)).isoformat()
+        archived = 0
+        
+        while not self._stop_event.is_set():
+            rows = self.db.get_expired_history(cutoff, self.batch_size)
+            if not rows:
+                break
+            self._write_segment(rows)
+            self.db.delete_history([row[0] for row in rows])
+            archived += len(rows)
+            if len(rows) < self.batch_size:
+                break
+        
+        rollup_cutoff = (datetime.now() - timedelta(days=self.rollup_retention_days)).date().isoformat()
+        self.db.prune_rollups(rollup_cutoff)
+        self.db.incremental_vacuum(self.vacuum_pages)
+        
+        if archived:
+            logger.info(f"Archived {archived} search history rows older than {cutoff}")
+        return archived
+    
+    def _write_segment(self, rows: List[tuple]):
+        """Write rows to a new gzip-compressed JSON lines segment"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        name = f"search_history-{rows[0][4][:10]}-{rows[0][0]}-{rows[-1][0]}.jsonl.gz"
+        path = os.path.join(self.archive_dir, name)
+        
+        # Segments are never modified once in place; write to a temp file first
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            for row_id, user_id, query, search_type, timestamp, results_count in rows:
+                f.write(json.dumps({
+                    "id": row_id,
+                    "user_id": user_id,
+                    "query": query,
+                    "search_type": search_type,
+                    "timestamp": timestamp,
+                    "results_count": results_count
+                }, ensure_ascii=False) + "\n")
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    
+    def _run(self):
+        """Background loop running maintenance every interval"""
+        while True:
+            try:
+                self.run_once()
+            except (sqlite3.Error, OSError) as e:
+                logger.error(f"Search history maintenance failed: {e}")
+            if self._stop_event.wait(self.interval):
+                return
+    
+    def start(self):
+        """Start the maintenance thread"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name="history-retention", daemon=True)
+            self._thread.start()
+    
+    def stop(self):
+        """Stop the maintenance thread"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+            self._thread = None
+
+# Initialize history retention
+retention = HistoryRetention(db)
+
+class PixabayAPI:
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self.base_url = PIXABAY_API_URL
+    
+    def build_request(self, query: str, search_type: str = "photo", per_page: int = 20, page: int = 1) -> tuple:
+        """Build the endpoint URL and query parameters for a search"""
+        params = {
+            "key": self.api_key,
+            "q": query,
+            "per_page": per_page,
+            "page": page,
+            "safesearch": "true"
+        }
+        
+        # Use different endpoints for video and music
+        if search_type == "video":
+            url = self.base_url + "videos/"
+        elif search_type == "music":
+            url = self.base_url + "music/"
+        else:
+            url = self.base_url
+            if search_type == "vector":
+                params["image_type"] = "vector"
+            elif search_type == "illustration":
+                params["image_type"] = "illustration"
+            elif search_type == "photo":
+                params["image_type"] = "photo"
+        
+        return url, params
+
+class PixabayQuotaScheduler:
+    """Hands out Pixabay API keys according to the quota each one has left"""
+    
+    def __init__(self, api_keys: List[str], default_limit: int = 100, window: float = 60,
+                 low_watermark: int = PIXABAY_QUOTA_LOW_WATERMARK, max_wait: float = PIXABAY_MAX_QUEUE_WAIT):
+        self.window = window
+        self.low_watermark = low_watermark
+        self.max_wait = max_wait
+        self.keys: Dict[str, Dict] = {
+            key: {"limit": default_limit, "remaining": default_limit, "reset_at": 0.0}
+            for key in api_keys
+        }
+        # Heap of (priority, sequence, future) waiting for quota
+        self._waiters: List[tuple] = []
+        self._sequence = 0
+        self._reset_timer: Optional[asyncio.TimerHandle] = None
+        self.counters = {"granted": 0, "queued": 0, "busy": 0, "rate_limited": 0}
+    
+    def _refresh(self, now: float):
+        """Restore the quota of keys whose window has reset"""
+        for state in self.keys.values():
+            if state["reset_at"] and state["reset_at"] <= now:
+                state["remaining"] = state["limit"]
+                state["reset_at"] = 0.0
+    
+    def _pick(self, priority: int) -> Optional[str]:
+        """Reserve a request on the key with the most quota left"""
+        self._refresh(time.monotonic())
+        # Below the watermark, the last requests of each window are kept for interactive searches
+        floor = 0 if priority == PRIORITY_INTERACTIVE else self.low_watermark
+        key, state = max(self.keys.items(), key=lambda item: item[1]["remaining"])
+        if state["remaining"] <= floor:
+            return None
+        state["remaining"] -= 1
+        if not state["reset_at"]:
+            state["reset_at"] = time.monotonic() + self.window
+        return key
+    
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE) -> Optional[str]:
+        """Get a key to use, waiting in priority order if quota is low; None means busy"""
+        key = self._pick(priority)
+        if key is not None:
+            self.counters["granted"] += 1
+            return key
+        
+        future = asyncio.get_running_loop().create_future()
+        self._sequence += 1
+        heapq.heappush(self._waiters, (priority, self._sequence, future))
+        self.counters["queued"] += 1
+        self._schedule_reset()
+        try:
+            key = await asyncio.wait_for(future, self.max_wait)
+            self.counters["granted"] += 1
+            return key
+        except asyncio.TimeoutError:
+            self.counters["busy"] += 1
+            return None
+    
+    def update(self, key: str, status_code: int, headers):
+        """Record the quota Pixabay reports for a key"""
+        state = self.keys[key]
+        try:
+            if "X-RateLimit-Limit" in headers:
+                state["limit"] = int(headers["X-RateLimit-Limit"])
+            if "X-RateLimit-Remaining" in headers:
+                state["remaining"] = int(headers["X-RateLimit-Remaining"])
+            if "X-RateLimit-Reset" in headers:
+                state["reset_at"] = time.monotonic() + float(headers["X-RateLimit-Reset"])
+        except ValueError:
+            logger.warning(f"Unexpected Pixabay rate limit headers: {dict(headers)}")
+        
+        if status_code == 429:
+            self.counters["rate_limited"] += 1
+            state["remaining"] = 0
+            if not state["reset_at"]:
+                state["reset_at"] = time.monotonic() + self.window
+        self._wake()
+    
+    def _wake(self):
+        """Hand freed quota to waiters, most important first"""
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            key = self._pick(priority)
+            if key is None:
+                break
+            heapq.heappop(self._waiters)
+            future.set_result(key)
+        if self._waiters:
+            self._schedule_reset()
+    
+    def _schedule_reset(self):
+        """Wake waiters when the next key's window resets"""
+        if self._reset_timer is not None:
+            return
+        pending = [state["reset_at"] for state in self.keys.values() if state["reset_at"]]
+        delay = max(min(pending) - time.monotonic(), 0) if pending else self.window
+        
+        def on_reset():
+            self._reset_timer = None
+            self._wake()
+        
+        self._reset_timer = asyncio.get_running_loop().call_later(delay, on_reset)
+    
+    def stats(self) -> Dict:
+        """Get per-pool quota and scheduling counters"""
+        stats = dict(self.counters)
+        stats["keys"] = len(self.keys)
+        stats["remaining"] = sum(state["remaining"] for state in self.keys.values())
+        stats["waiting"] = len(self._waiters)
+        return stats
+
+class AsyncPixabayAPI(PixabayAPI):
+    """Non-blocking Pixabay client sharing one keep-alive HTTP session"""
+    
+    def __init__(self, api_key: str, timeout: float = PIXABAY_TIMEOUT, max_connections: int = PIXABAY_MAX_CONNECTIONS,
+                 api_keys: List[str] = None):
+        super().__init__(api_key)
+        self.scheduler = PixabayQuotaScheduler(api_keys or [api_key])
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    def get_client(self) -> httpx.AsyncClient:
+        """Get the shared HTTP client, creating it on first use"""
+        loop = asyncio.get_running_loop()
+        # Pooled connections are bound to the loop that opened them
+        if self._client is None or self._client.is_closed or self._client_loop is not loop:
+            self._client_loop = loop
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=60
+                )
+            )
+        return self._client
+    
+    async def search(self, query: str, search_type: str = "photo", per_page: int = 20, page: int = 1,
+                     timeout: float = None, priority: int = PRIORITY_INTERACTIVE) -> Dict:
+        """Search Pixabay API without blocking the event loop"""
+        url, params = self.build_request(query, search_type, per_page, page)
+        
+        waited_from = time.perf_counter()
+        key = await self.scheduler.acquire(priority)
+        waited = time.perf_counter() - waited_from
+        if waited > 0.001:
+            tracer.span("pixabay", "quota wait", waited_from, waited)
+        if key is None:
+            metrics.inc("pixabay_quota_rejections_total")
+            return {"hits": [], "total": 0, "error": "quota exhausted", "busy": True}
+        params["key"] = key
+        
+        start = time.perf_counter()
+        status = "error"
+        try:
+            # Overall deadline for the request, including connection setup
+            async with asyncio.timeout(timeout or self.timeout):
+                response = await self.get_client().get(url, params=params)
+            status = str(response.status_code)
+            
+            self.scheduler.update(key, response.status_code, response.headers)
+            if response.status_code == 429:
+                logger.warning("Pixabay rate limit reached")
+                return {"hits": [], "total": 0, "error": "rate limited", "busy": True}
+            response.raise_for_status()
+            
+            return response.json()
+            
+        except (httpx.HTTPError, TimeoutError, ValueError) as e:
+            logger.error(f"Pixabay API error: {e!r}")
+            if isinstance(e, TimeoutError):
+                status = "timeout"
+            # Flag failures so callers can tell them apart from a genuine empty result
+            return {"hits": [], "total": 0, "error": repr(e)}
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe("pixabay_request_seconds", elapsed, (("status", status),))
+            tracer.span("pixabay", f"{search_type} page {page} {status}", start, elapsed)
+    
+    async def close(self):
+        """Close the shared HTTP session"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._client_loop = None
+
+# Folds Arabic spelling variants: hamza/madda forms of alef, taa marbuta, alef maqsura, Persian letters,
+# Eastern digits; tatweel and diacritics are dropped
+_ARABIC_FOLD = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ة": "ه", "ى": "ي", "ؤ": "و", "ئ": "ي", "ی": "ي", "ک": "ك",
+    "ـ": None, "ٰ": None,
+    **{chr(code): None for code in range(0x064B, 0x0653)},
+    **{chr(0x0660 + digit): str(digit) for digit in range(10)},
+    **{chr(0x06F0 + digit): str(digit) for digit in range(10)},
+})
+
+def normalize_query(query: str) -> str:
+    """Normalize a search query for use as a cache key"""
+    if query.isascii():
+        return " ".join(query.lower().split())
+    # NFKC turns Arabic presentation forms and full-width Latin into their plain letters
+    query = unicodedata.normalize("NFKC", query).translate(_ARABIC_FOLD)
+    return " ".join(query.casefold().split())
+
+@functools.lru_cache(maxsize=None)
+def query_dictionary() -> Dict[str, str]:
+    """Load the Arabic-to-English term dictionary, keyed by normalized term"""
+    if not QUERY_DICTIONARY_PATH:
+        return {}
+    try:
+        with open(QUERY_DICTIONARY_PATH, encoding="utf-8") as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"Query dictionary disabled: {e}")
+        return {}
+    return {normalize_query(term): " ".join(unicodedata.normalize("NFKC", english).split())
+            for term, english in entries.items()}
+
+def search_text(query: str) -> str:
+    """Get the text to send to Pixabay for a typed query: its dictionary translation, or the query in NFKC form
+    
+    Spelling variants still share a cache entry, since the cache keys on normalize_query() of this text.
+    """
+    text = " ".join(unicodedata.normalize("NFKC", query).split())
+    dictionary = query_dictionary()
+    if not dictionary or text.isascii():
+        return text
+    key = normalize_query(text)
+    if key in dictionary:
+        return dictionary[key]
+    # Translate word by word only when every Arabic word is known; a half-translated query matches neither language
+    words = [word if word.isascii() else dictionary.get(word) for word in key.split()]
+    return text if None in words else " ".join(words)
+
+class SearchCache:
+    """TTL + LRU cache of Pixabay responses with an optional on-disk copy"""
+    
+    def __init__(self, ttl: float = PIXABAY_CACHE_TTL, max_entries: int = PIXABAY_CACHE_MAX_ENTRIES,
+                 max_bytes: int = PIXABAY_CACHE_MAX_BYTES, path: str = PIXABAY_CACHE_PATH):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        # key -> (expires_at, size_in_bytes, response)
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk: Optional[sqlite3.Connection] = None
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "disk_hits": 0, "coalesced": 0,
+                         "stale_served": 0}
+        
+        if path:
+            self._open_disk()
+    
+    def _open_disk(self):
+        """Open the persistent cache file and drop expired entries"""
+        try:
+            self._disk = sqlite3.connect(self.path, check_same_thread=False)
+            self._disk.execute('PRAGMA journal_mode=WAL')
+            self._disk.execute('PRAGMA synchronous=NORMAL')
+            with self._disk:
+                self._disk.execute('''
+                    CREATE TABLE IF NOT EXISTS search_cache (
+                        cache_key TEXT PRIMARY KEY,
+                        expires_at REAL,
+                        payload TEXT
+                    )
+                ''')
+                self._disk.execute('DELETE FROM search_cache WHERE expires_at < ?', (time.time(),))
+        except sqlite3.Error as e:
+            logger.error(f"Search cache persistence disabled: {e}")
+            self._disk = None
+    
+    @staticmethod
+    def make_key(query: str, search_type: str, per_page: int, page: int) -> tuple:
+        """Build the cache key for a search"""
+        return (normalize_query(query), search_type, per_page, page)
+    
+    def get(self, key: tuple) -> Optional[Dict]:
+        """Get a cached response, or None if missing or expired"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return entry[2]
+                # Expired entries stay until evicted so get_stale can still serve them
+                self.counters["expirations"] += 1
+            
+            payload = self._disk_get(key, now)
+            if payload is None:
+                self.counters["misses"] += 1
+                return None
+            
+            expires_at, response = payload
+            self._store(key, response, expires_at, len(json.dumps(response)))
+            self.counters["hits"] += 1
+            self.counters["disk_hits"] += 1
+            return response
+    
+    def get_stale(self, key: tuple) -> Optional[Dict]:
+        """Get a cached response even if its TTL has passed"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[2] if entry is not None else None
+    
+    def put(self, key: tuple, response: Dict):
+        """Store a response, evicting least recently used entries as needed"""
+        encoded = json.dumps(response)
+        size = len(encoded)
+        if size > self.max_bytes:
+            return
+        
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._store(key, response, expires_at, size)
+            if self._disk is not None:
+                try:
+                    with self._disk:
+                        self._disk.execute(
+                            'INSERT OR REPLACE INTO search_cache (cache_key, expires_at, payload) VALUES (?, ?, ?)',
+                            (json.dumps(key), expires_at, encoded)
+                        )
+                except sqlite3.Error as e:
+                    logger.warning(f"Failed to persist search cache entry: {e}")
+    
+    def _store(self, key: tuple, response: Dict, expires_at: float, size: int):
+        """Insert an entry and enforce the entry and memory budgets"""
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, size, response)
+        self._bytes += size
+        
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.counters["evictions"] += 1
+    
+    def _remove(self, key: tuple):
+        """Remove an entry from memory"""
+        entry = self._entries.pop(key)
+        self._bytes -= entry[1]
+    
+    def _disk_get(self, key: tuple, now: float) -> Optional[tuple]:
+        """Read an unexpired entry from the persistent cache"""
+        if self._disk is None:
+            return None
+        try:
+            row = self._disk.execute(
+                'SELECT expires_at, payload FROM search_cache WHERE cache_key = ? AND expires_at > ?',
+                (json.dumps(key), now)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to read search cache entry: {e}")
+            return None
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+    
+    def stats(self) -> Dict:
+        """Get cache counters and current size"""
+        with self._lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        return stats
+
+class CachedPixabayAPI:
+    """Pixabay client that serves repeated searches from a SearchCache"""
+    
+    def __init__(self, api: AsyncPixabayAPI, cache: SearchCache):
+        self.api = api
+        self.cache = cache
+        # Upstream fetches in flight, shared by concurrent identical misses
+        self._inflight: Dict[tuple, asyncio.Task] = {}
+    
+    async def search(self, query: str, search_type: str = "photo", per_page: int = 20, page: int = 1,
+                     priority: int = PRIORITY_INTERACTIVE) -> Dict:
+        """Search Pixabay, using the cache and coalescing identical requests"""
+        key = self.cache.make_key(query, search_type, per_page, page)
+        
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, query, search_type, per_page, page, priority))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.cache.counters["coalesced"] += 1
+        
+        # Shield so one cancelled caller does not cancel the fetch for the others
+        return await asyncio.shield(task)
+    
+    async def _fetch(self, key: tuple, query: str, search_type: str, per_page: int, page: int, priority: int) -> Dict:
+        """Fetch from Pixabay and cache successful responses"""
+        response = await self.api.search(query, search_type, per_page, page, priority=priority)
+        if "error" not in response:
+            self.cache.put(key, response)
+        elif response.get("busy"):
+            # Out of quota: an expired answer beats telling the user nothing was found
+            stale = self.cache.get_stale(key)
+            if stale is not None:
+                self.cache.counters["stale_served"] += 1
+                return stale
+        return response
+    
+    async def close(self):
+        """Close the underlying HTTP session"""
+        await self.api.close()
+
+# Initialize Pixabay API
+pixabay = LazyComponent(lambda: CachedPixabayAPI(AsyncPixabayAPI(PIXABAY_API_KEY, api_keys=PIXABAY_API_KEYS), SearchCache()))
+
+def select_media(result: Dict, search_type: str) -> tuple:
+    """Pick how to send a result: (media kind, URL, rendition, text shown when unavailable)"""
+    if search_type == "video" and result.get('videos'):
+        return "video", result['videos'].get('medium', {}).get('url', ''), "medium", "❌ فيديو غير متوفر"
+    if search_type == "music":
+        return "audio", result.get('previewURL') or result.get('webformatURL', ''), "preview", "🎵 موسيقى غير متوفرة للتشغيل"
+    if search_type == "gif":
+        gif_url = result.get('webformatURL', '')
+        # Fall back to a photo if it is not a proper GIF
+        kind = "animation" if gif_url and gif_url.lower().endswith('.gif') else "photo"
+        return kind, gif_url, "webformat", None
+    # For photos, illustrations, vectors
+    return "photo", result.get('webformatURL', ''), "webformat", "❌ صورة غير متوفرة"
+
+def message_media_kind(message) -> Optional[str]:
+    """Get the kind of media a message shows, or None for text messages"""
+    # Animations also carry a document, so check them first
+    for kind in ("animation", "video", "audio", "photo"):
+        if getattr(message, kind, None):
+            return kind
+    return None
+
+class MediaCache:
+    """Maps Pixabay media to the Telegram file_id returned after the first upload
+    
+    The table is loaded into memory at startup, so lookups never touch the database; changes are
+    written behind by the accounting writer.
+    """
+    
+    def __init__(self, database: Database, writer: AccountingWriter, max_entries: int = MEDIA_CACHE_SIZE):
+        self.db = database
+        self.writer = writer
+        self.max_entries = max_entries
+        # (hit_id, kind, rendition) -> file_id, least recently used first
+        self._entries: "OrderedDict[tuple, str]" = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0, "rejected": 0}
+    
+    def load(self):
+        """Load the most recently cached file_ids from the database"""
+        for key, file_id in self.db.get_media_file_ids(self.max_entries):
+            self._remember(key, file_id)
+        logger.info(f"Loaded {len(self._entries)} cached file_ids")
+    
+    @staticmethod
+    def make_key(result: Dict, kind: str, rendition: str) -> Optional[tuple]:
+        """Build the cache key for a result, or None if it has no Pixabay ID"""
+        hit_id = result.get('id')
+        if hit_id is None:
+            return None
+        return (str(hit_id), kind, rendition)
+    
+    def get(self, key: tuple) -> Optional[str]:
+        """Get a cached file_id"""
+        file_id = self._entries.get(key)
+        if file_id is not None:
+            self._entries.move_to_end(key)
+        self.counters["hits" if file_id is not None else "misses"] += 1
+        return file_id
+    
+    def put(self, key: tuple, file_id: str):
+        """Cache the file_id Telegram assigned to a media item"""
+        if self._entries.get(key) == file_id:
+            return
+        self._remember(key, file_id)
+        self.writer.record_media_file_id(key, file_id)
+    
+    def discard(self, key: tuple):
+        """Forget a file_id that Telegram rejected"""
+        self.counters["rejected"] += 1
+        self._entries.pop(key, None)
+        self.writer.record_media_file_id(key, None)
+    
+    def _remember(self, key: tuple, file_id: str):
+        """Store a file_id in memory, evicting the least recently used"""
+        self._entries[key] = file_id
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    @staticmethod
+    def file_id_from_message(message, kind: str) -> Optional[str]:
+        """Extract the file_id of the media in a sent message"""
+        media = getattr(message, kind, None)
+        if kind == "photo":
+            media = media[-1] if media else None
+        elif media is None and kind == "animation":
+            # Some GIFs come back as documents
+            media = message.document
+        return media.file_id if media else None
+
+class TokenBucket:
+    """Async token bucket rate limiter"""
+    
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    def pause(self, seconds: float):
+        """Stop handing out tokens for a while, e.g. after a flood-control error"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+    
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class BroadcastEngine:
+    """Background, rate-limited and resumable broadcast jobs"""
+    
+    def __init__(self, bot: Bot, database: Database, rate: float = BROADCAST_RATE,
+                 concurrency: int = BROADCAST_CONCURRENCY, batch_size: int = BROADCAST_BATCH_SIZE,
+                 progress_interval: float = BROADCAST_PROGRESS_INTERVAL):
+        self.bot = bot
+        self.db = database
+        # Telegram allows roughly 30 messages per second across all chats
+        self.limiter = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self._tasks: Dict[int, asyncio.Task] = {}
+    
+    async def start(self, admin_id: int, chat_id: int, text: str) -> int:
+        """Create a broadcast job and run it in the background"""
+        job_id = self.db.create_broadcast(admin_id, chat_id, text)
+        job = {
+            "id": job_id,
+            "chat_id": chat_id,
+            "progress_message_id": None,
+            "text": text,
+            "last_user_id": 0,
+            "sent": 0,
+            "failed": 0,
+            "blocked": 0
+        }
+        self._spawn(job)
+        return job_id
+    
+    async def resume(self):
+        """Resume broadcasts that were interrupted by a restart"""
+        for job in self.db.get_unfinished_broadcasts():
+            logger.info(f"Resuming broadcast #{job['id']} after user {job['last_user_id']}")
+            self._spawn(job)
+    
+    async def stop(self):
+        """Cancel running broadcasts; they resume from their checkpoint on next start"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def _spawn(self, job: Dict):
+        """Run a job as a background task"""
+        task = asyncio.create_task(self._run(job))
+        self._tasks[job["id"]] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job["id"], None))
+    
+    async def _run(self, job: Dict):
+        """Send a job's message to every recipient, checkpointing after each page"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        last_report = 0.0
+        
+        try:
+            if job["progress_message_id"] is None:
+                message = await self.bot.send_message(chat_id=job["chat_id"], text=self._progress_text(job))
+                job["progress_message_id"] = message.message_id
+                self.db.set_broadcast_progress_message(job["id"], message.message_id)
+            
+            while True:
+                user_ids = self.db.get_broadcast_recipients(job["last_user_id"], self.batch_size)
+                if not user_ids:
+                    break
+                
+                outcomes = await asyncio.gather(*(self._send(user_id, job["text"], semaphore) for user_id in user_ids))
+                
+                blocked_ids = [user_id for user_id, outcome in zip(user_ids, outcomes) if outcome == "blocked"]
+                if blocked_ids:
+                    self.db.mark_users_blocked(blocked_ids)
+                job["sent"] += outcomes.count("sent")
+                job["failed"] += outcomes.count("failed")
+                job["blocked"] += len(blocked_ids)
+                job["last_user_id"] = user_ids[-1]
+                self.db.update_broadcast(job["id"], "running", job["last_user_id"], job["sent"], job["failed"], job["blocked"])
+                
+                if time.monotonic() - last_report >= self.progress_interval:
+                    last_report = time.monotonic()
+                    await self._report(job)
+            
+            self.db.update_broadcast(job["id"], "done", job["last_user_id"], job["sent"], job["failed"], job["blocked"])
+            await self._report(job, done=True)
+            logger.info(f"Broadcast #{job['id']} finished: {job['sent']} sent, {job['failed']} failed, {job['blocked']} blocked")
+        
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast #{job['id']} failed: {e}")
+            self.db.update_broadcast(job["id"], "failed", job["last_user_id"], job["sent"], job["failed"], job["blocked"])
+    
+    async def _send(self, user_id: int, text: str, semaphore: asyncio.Semaphore) -> str:
+        """Send one message and classify the outcome as sent, blocked or failed"""
+        async with semaphore:
+            for _ in range(BROADCAST_MAX_RETRIES):
+                await self.limiter.acquire()
+                try:
+                    await self.bot.send_message(chat_id=user_id, text=text)
+                    return "sent"
+                except RetryAfter as e:
+                    logger.warning(f"Broadcast flood control, pausing for {e.retry_after}s")
+                    self.limiter.pause(e.retry_after)
+                except Forbidden:
+                    return "blocked"
+                except BadRequest as e:
+                    if "chat not found" in str(e).lower():
+                        return "blocked"
+                    logger.error(f"Failed to send message to {user_id}: {e}")
+                    return "failed"
+                except TelegramError as e:
+                    logger.error(f"Failed to send message to {user_id}: {e}")
+                    return "failed"
+            return "failed"
+    
+    def _progress_text(self, job: Dict, done: bool = False) -> str:
+        """Format the admin's progress message"""
+        header = "✅ اكتمل البث" if done else "📤 جاري البث..."
+        return f"""{header} #{job['id']}
+
+✅ تم الإرسال: {job['sent']}
+❌ فشل: {job['failed']}
+🚫 حظروا البوت: {job['blocked']}"""
+    
+    async def _report(self, job: Dict, done: bool = False):
+        """Update the admin's progress message"""
+        try:
+            await self.bot.edit_message_text(
+                chat_id=job["chat_id"],
+                message_id=job["progress_message_id"],
+                text=self._progress_text(job, done)
+            )
+        except TelegramError as e:
+            logger.warning(f"Failed to update broadcast progress: {e}")
+
+class SubscriptionChecker:
+    """Concurrent mandatory-channel membership checks with a TTL cache"""
+    
+    def __init__(self, bot: Bot, database: Database, positive_ttl: float = SUBSCRIPTION_POSITIVE_TTL,
+                 negative_ttl: float = SUBSCRIPTION_NEGATIVE_TTL, max_entries: int = SUBSCRIPTION_CACHE_SIZE):
+        self.bot = bot
+        self.db = database
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        # (user_id, channel_id) -> (expires_at, is_member)
+        self._members: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._channels: Optional[List[Dict]] = None
+    
+    def get_channels(self) -> List[Dict]:
+        """Get the mandatory channels, cached until the list changes"""
+        if self._channels is None:
+            self._channels = self.db.get_mandatory_channels()
+        return self._channels
+    
+    def invalidate(self):
+        """Forget cached channels and memberships after the channel list changes"""
+        self._channels = None
+        self._members.clear()
     
-    def add_search_history(self, user_id: int, query: str, search_type: str, results_count: int):
-        """Add search to history"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO search_history (user_id, query, search_type, timestamp, results_count)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, query, search_type, datetime.now().isoformat(), results_count))
+    async def _is_member(self, user_id: int, channel: Dict, recheck_negative: bool) -> bool:
+        """Check one membership, using the cache when possible"""
+        key = (user_id, channel["id"])
+        cached = self._members.get(key)
+        if cached is not None and cached[0] > time.monotonic() and (cached[1] or not recheck_negative):
+            return cached[1]
         
-        conn.commit()
-        conn.close()
+        try:
+            member = await self.bot.get_chat_member(channel["id"], user_id)
+            is_member = member.status not in ['left', 'kicked']
+        except TelegramError:
+            is_member = False
+        
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        self._members[key] = (time.monotonic() + ttl, is_member)
+        self._members.move_to_end(key)
+        while len(self._members) > self.max_entries:
+            self._members.popitem(last=False)
+        return is_member
     
-    def get_statistics(self) -> Dict:
-        """Get bot statistics"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        # Total users
-        cursor.execute('SELECT COUNT(*) FROM users')
-        total_users = cursor.fetchone()[0]
-        
-        # Total searches
-        cursor.execute('SELECT SUM(search_count) FROM users')
-        total_searches = cursor.fetchone()[0] or 0
-        
-        # Mandatory channels count
-        cursor.execute('SELECT COUNT(*) FROM mandatory_channels')
-        mandatory_channels_count = cursor.fetchone()[0]
+    async def get_unsubscribed_channels(self, user_id: int, recheck_negative: bool = False) -> List[Dict]:
+        """Get the mandatory channels the user has not joined, checking them concurrently"""
+        channels = self.get_channels()
+        if not channels:
+            return []
+        
+        results = await asyncio.gather(*(self._is_member(user_id, channel, recheck_negative) for channel in channels))
+        return [channel for channel, is_member in zip(channels, results) if not is_member]
+
+class Prefetcher:
+    """Warms the results next to the one a user is viewing"""
+    
+    def __init__(self, telegram_bot: "TelegramBot", http: AsyncPixabayAPI, cache_chat_id: str = PREFETCH_CHAT_ID,
+                 distance: int = PREFETCH_DISTANCE, concurrency: int = PREFETCH_CONCURRENCY,
+                 max_checked_urls: int = 5000, url_check_ttl: float = PREFETCH_URL_CHECK_TTL):
+        self.telegram_bot = telegram_bot
+        self.http = http
+        # Chat where media is uploaded once to obtain a file_id; without it URLs are only validated
+        self.cache_chat_id = cache_chat_id
+        self.distance = distance
+        self.concurrency = concurrency
+        self.max_checked_urls = max_checked_urls
+        self.url_check_ttl = url_check_ttl
+        self._tasks: Dict[int, List[asyncio.Task]] = {}
+        # URL -> (gone?, expires_at), oldest check first
+        self._checked_urls: "OrderedDict[str, tuple]" = OrderedDict()
+    
+    def _url_check(self, url: str) -> Optional[bool]:
+        """Get whether a recent check found a URL gone, or None if there is no current check"""
+        entry = self._checked_urls.get(url)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+    
+    def is_bad_url(self, url: str) -> bool:
+        """Check whether a prefetch recently found a media URL gone"""
+        return self._url_check(url) is True
+    
+    def schedule(self, user_id: int, results: ResultCursor, index: int, search_type: str):
+        """Start warming the neighbours of a result, replacing the user's previous prefetch"""
+        self.cancel(user_id)
+        if len(results) < 2:
+            return
         
-        # Banned users count
-        cursor.execute('SELECT COUNT(*) FROM users WHERE is_banned = 1')
-        banned_users = cursor.fetchone()[0]
+        neighbours = []
+        for step in range(1, self.distance + 1):
+            for neighbour in ((index + step) % len(results), (index - step) % len(results)):
+                if neighbour != index and neighbour not in neighbours:
+                    neighbours.append(neighbour)
+        
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # Neighbours on pages outside the loaded window are skipped
+        tasks = [
+            asyncio.create_task(self._warm(results.get(i), search_type, semaphore))
+            for i in neighbours if results.get(i) is not None
+        ]
+        if not tasks:
+            return
+        self._tasks[user_id] = tasks
+        # Drop the entry once the last task finishes unless a newer prefetch replaced it
+        pending = set(tasks)
         
-        conn.close()
+        def finished(task: asyncio.Task):
+            pending.discard(task)
+            if not pending and self._tasks.get(user_id) is tasks:
+                del self._tasks[user_id]
         
-        return {
-            "total_users": total_users,
-            "total_searches": total_searches,
-            "mandatory_channels": mandatory_channels_count,
-            "banned_users": banned_users
-        }
+        for task in tasks:
+            task.add_done_callback(finished)
     
-    def set_user_session(self, user_id: int, query: str = None, search_type: str = None, results: str = None, index: int = 0):
-        """Set user session data"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO user_sessions 
-            (user_id, current_query, current_type, current_results, current_index)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, query or "", search_type or "", results or "", index))
-        
-        conn.commit()
-        conn.close()
+    def cancel(self, user_id: int):
+        """Cancel a user's pending prefetch work"""
+        for task in self._tasks.pop(user_id, []):
+            task.cancel()
     
-    def get_user_session(self, user_id: int) -> Optional[Dict]:
-        """Get user session data"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT current_query, current_type, current_results, current_index FROM user_sessions WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        
-        conn.close()
+    async def _warm(self, result: Dict, search_type: str, semaphore: asyncio.Semaphore):
+        """Cache a result's file_id, or at least check its URL"""
+        kind, url, rendition, _ = select_media(result, search_type)
+        if not url:
+            return
+        key = self.telegram_bot.media_cache.make_key(result, kind, rendition)
+        if key and self.telegram_bot.media_cache.get(key):
+            return
         
-        if result:
-            return {
-                "query": result[0],
-                "type": result[1],
-                "results": result[2],
-                "index": result[3]
-            }
-        return None
-
-# Initialize database
-db = Database()
+        async with semaphore:
+            try:
+                if self.cache_chat_id and key:
+                    message = await self.telegram_bot.send_media(self.cache_chat_id, result, search_type, None)
+                    await self.telegram_bot.bot.delete_message(chat_id=self.cache_chat_id, message_id=message.message_id)
+                elif self._url_check(url) is None:
+                    response = await self.http.get_client().head(url, follow_redirects=True)
+                    # Only definitive answers count; errors and throttling may pass on the next try
+                    if response.status_code < 400 or response.status_code in (404, 410):
+                        self._remember_url(url, response.status_code >= 400)
+            except asyncio.CancelledError:
+                raise
+            except (TelegramError, httpx.HTTPError) as e:
+                logger.debug(f"Prefetch failed for {url}: {e}")
+    
+    def _remember_url(self, url: str, gone: bool):
+        """Record a URL check, forgetting the oldest ones"""
+        self._checked_urls[url] = (gone, time.monotonic() + self.url_check_ttl)
+        self._checked_urls.move_to_end(url)
+        while len(self._checked_urls) > self.max_checked_urls:
+            self._checked_urls.popitem(last=False)
 
-class PixabayAPI:
-    def __init__(self, api_key: str):
-        self.api_key = api_key
-        self.base_url = PIXABAY_API_URL
+class InstrumentedRequest(HTTPXRequest):
+    """Bot API transport that records call latency by method and outcome"""
     
-    def search(self, query: str, search_type: str = "photo", per_page: int = 20) -> Dict:
-        """Search Pixabay API"""
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs) -> tuple:
+        endpoint = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        status = "error"
         try:
-            params = {
-                "key": self.api_key,
-                "q": query,
-                "per_page": per_page,
-                "safesearch": "true"
-            }
-            
-            # Use different endpoints for video and music
-            if search_type == "video":
-                url = "https://pixabay.com/api/videos/"
-            elif search_type == "music":
-                url = "https://pixabay.com/api/music/"
-            else:
-                url = self.base_url
-                if search_type == "vector":
-                    params["image_type"] = "vector"
-                elif search_type == "illustration":
-                    params["image_type"] = "illustration"
-                elif search_type == "photo":
-                    params["image_type"] = "photo"
-            
-            response = requests.get(url, params=params, timeout=10)
-            response.raise_for_status()
-            
-            return response.json()
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Pixabay API error: {e}")
-            return {"hits": [], "total": 0}
-
-# Initialize Pixabay API
-pixabay = PixabayAPI(PIXABAY_API_KEY)
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        except Exception as e:
+            status = type(e).__name__
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe("telegram_api_request_seconds", elapsed, (("method", endpoint), ("status", status)))
+            tracer.span("telegram", endpoint if status == "200" else f"{endpoint} {status}", start, elapsed)
 
 class TelegramBot:
     def __init__(self, token: str):
         self.token = token
-        self.bot = Bot(token)
-        self.application = Application.builder().token(token).build()
+        # The default transport holds a single connection, which would serialize the update workers
+        self.bot = Bot(token, base_url=TELEGRAM_API_URL, request=InstrumentedRequest(connection_pool_size=BOT_API_POOL_SIZE))
+        self.application = (
+            Application.builder()
+            .token(token)
+            .base_url(TELEGRAM_API_URL)
+            .request(InstrumentedRequest(connection_pool_size=BOT_API_POOL_SIZE))
+            .build()
+        )
+        self.subscriptions = SubscriptionChecker(self.bot, db)
+        self.broadcasts = BroadcastEngine(self.bot, db)
+        self.media_cache = MediaCache(db, accounting)
+        self.prefetcher = Prefetcher(self, pixabay.api)
         self.setup_handlers()
     
     def setup_handlers(self):
@@ -333,22 +2525,7 @@ class TelegramBot:
             return
         
         # Check subscription to mandatory channels
-        mandatory_channels = db.get_mandatory_channels()
-        
-        if not mandatory_channels:
-            # No mandatory channels, proceed directly
-            await self.show_main_menu(update, context)
-            return
-        
-        # Check subscription status
-        unsubscribed_channels = []
-        for channel in mandatory_channels:
-            try:
-                member = await self.bot.get_chat_member(channel["id"], user_id)
-                if member.status in ['left', 'kicked']:
-                    unsubscribed_channels.append(channel)
-            except TelegramError:
-                unsubscribed_channels.append(channel)
+        unsubscribed_channels = await self.subscriptions.get_unsubscribed_channels(user_id)
         
         if unsubscribed_channels:
             await self.show_subscription_message(update, context, unsubscribed_channels)
@@ -414,7 +2591,7 @@ class TelegramBot:
     async def show_search_type_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show search type selection menu"""
         user_id = update.effective_user.id
-        session = db.get_user_session(user_id) or {}
+        session = sessions.get(user_id) or {}
         current_type = session.get("type", "photo")
         
         search_types = [
@@ -466,17 +2643,8 @@ class TelegramBot:
             return
         
         if data == "verify_subscription":
-            # Re-check subscription
-            mandatory_channels = db.get_mandatory_channels()
-            unsubscribed_channels = []
-            
-            for channel in mandatory_channels:
-                try:
-                    member = await self.bot.get_chat_member(channel["id"], user_id)
-                    if member.status in ['left', 'kicked']:
-                        unsubscribed_channels.append(channel)
-                except TelegramError:
-                    unsubscribed_channels.append(channel)
+            # Re-check subscription, ignoring cached "not subscribed" answers
+            unsubscribed_channels = await self.subscriptions.get_unsubscribed_channels(user_id, recheck_negative=True)
             
             if unsubscribed_channels:
                 await self.show_subscription_message(update, context, unsubscribed_channels)
@@ -492,11 +2660,11 @@ class TelegramBot:
         
         elif data.startswith("set_type_"):
             search_type = data.replace("set_type_", "")
-            db.set_user_session(user_id, search_type=search_type)
+            sessions.set(user_id, search_type=search_type)
             await self.show_search_type_menu(update, context)
         
         elif data == "start_typed_search":
-            session = db.get_user_session(user_id)
+            session = sessions.get(user_id)
             if session and session.get("type"):
                 await query.edit_message_text(f"أرسل كلمة البحث عن {session['type']}:")
                 context.user_data["waiting_for_search"] = True
@@ -507,11 +2675,11 @@ class TelegramBot:
         elif data == "back_to_main":
             await self.show_main_menu(update, context)
         
-        elif data.startswith("nav_"):
+        elif data.startswith("nav_") or data.startswith("nav:"):
             await self.handle_navigation(update, context, data)
         
-        elif data == "select_result":
-            await self.select_result(update, context)
+        elif data == "select_result" or data.startswith("sel:"):
+            await self.select_result(update, context, data)
         
         elif data.startswith("admin_"):
             if user_id == ADMIN_ID:
@@ -524,106 +2692,77 @@ class TelegramBot:
     async def handle_navigation(self, update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
         """Handle navigation between search results"""
         user_id = update.effective_user.id
-        session = db.get_user_session(user_id)
+        token = decode_nav_token(data, user_id) if data.startswith("nav:") else None
+        
+        if token:
+            # The button carries its own search and target, so no session lookup is needed
+            results = sessions.get_cursor(user_id, token["session_id"])
+            new_index = token["index"]
+            search_type = token["type"]
+        elif data in ("nav_next", "nav_prev"):
+            # Buttons sent before navigation tokens existed
+            session = sessions.get(user_id)
+            results = session["results"] if session else None
+            search_type = session["type"] if session else None
+            if results:
+                step = 1 if data == "nav_next" else -1
+                new_index = (session["index"] + step) % len(results)
+        else:
+            return
         
-        if not session or not session["results"]:
+        if not results:
             await update.callback_query.edit_message_text("لا توجد نتائج للتنقل فيها")
             return
         
-        results = json.loads(session["results"])
-        current_index = session["index"]
-        
-        if data == "nav_next":
-            new_index = (current_index + 1) % len(results)
-        elif data == "nav_prev":
-            new_index = (current_index - 1) % len(results)
-        else:
+        # Load the page on demand and start on the next one before the user gets there
+        if not await results.ensure(new_index):
+            # The query was already answered, so the buttons stay and the user can try again
+            await update.callback_query.message.reply_text("⏳ تعذر تحميل هذه النتيجة الآن، حاول مرة أخرى")
             return
+        results.prefetch(new_index)
         
         # Update session with new index
-        db.set_user_session(user_id, session["query"], session["type"], session["results"], new_index)
+        sessions.set_index(user_id, new_index, session_id=results.session_id)
         
         # Show new result
-        await self.show_search_result(update, context, results, new_index, edit_message=True)
+        await self.show_search_result(update, context, results, new_index, edit_message=True,
+                                      search_type=search_type)
     
-    async def select_result(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def select_result(self, update: Update, context: ContextTypes.DEFAULT_TYPE, data: str = "select_result"):
         """Select current result and remove navigation buttons"""
         user_id = update.effective_user.id
-        session = db.get_user_session(user_id)
+        token = decode_nav_token(data, user_id) if data.startswith("sel:") else None
+        
+        if token:
+            results = sessions.get_cursor(user_id, token["session_id"])
+            current_index = token["index"]
+            search_type = token["type"]
+        else:
+            session = sessions.get(user_id)
+            results = session["results"] if session else None
+            current_index = session["index"] if session else 0
+            search_type = session.get("type", "photo") if session else "photo"
         
-        if not session or not session["results"]:
+        if not results or not await results.ensure(current_index):
             await update.callback_query.edit_message_text("لا توجد نتائج محددة")
             return
         
-        results = json.loads(session["results"])
-        current_index = session["index"]
         result = results[current_index]
-        search_type = session.get("type", "photo")
         
         # Prepare final caption
         final_caption = f"✅ تم الاختيار\n🏷️ {result.get('tags', 'غير محدد')}"
         
         chat_id = update.callback_query.message.chat_id
         
+        # The user is leaving the result list
+        self.prefetcher.cancel(user_id)
+        
         try:
             # Delete the message with navigation buttons
             await update.callback_query.message.delete()
             
             # Send the selected media without navigation buttons
-            if search_type == "video" and result.get('videos'):
-                video_url = result['videos'].get('medium', {}).get('url', '')
-                if video_url:
-                    await self.bot.send_video(
-                        chat_id=chat_id,
-                        video=video_url,
-                        caption=final_caption
-                    )
-                else:
-                    await self.bot.send_message(
-                        chat_id=chat_id,
-                        text=f"{final_caption}\n❌ فيديو غير متوفر"
-                    )
-            elif search_type == "music":
-                music_url = result.get('previewURL') or result.get('webformatURL', '')
-                if music_url:
-                    await self.bot.send_audio(
-                        chat_id=chat_id,
-                        audio=music_url,
-                        caption=final_caption
-                    )
-                else:
-                    await self.bot.send_message(
-                        chat_id=chat_id,
-                        text=f"{final_caption}\n🎵 موسيقى غير متوفرة للتشغيل"
-                    )
-            elif search_type == "gif":
-                gif_url = result.get('webformatURL', '')
-                if gif_url and gif_url.lower().endswith('.gif'):
-                    await self.bot.send_animation(
-                        chat_id=chat_id,
-                        animation=gif_url,
-                        caption=final_caption
-                    )
-                else:
-                    await self.bot.send_photo(
-                        chat_id=chat_id,
-                        photo=gif_url,
-                        caption=final_caption
-                    )
-            else:
-                # For photos, illustrations, vectors
-                photo_url = result.get('webformatURL', '')
-                if photo_url:
-                    await self.bot.send_photo(
-                        chat_id=chat_id,
-                        photo=photo_url,
-                        caption=final_caption
-                    )
-                else:
-                    await self.bot.send_message(
-                        chat_id=chat_id,
-                        text=f"{final_caption}\n❌ صورة غير متوفرة"
-                    )
+            await self.send_media(chat_id, result, search_type, final_caption)
                     
         except Exception as e:
             logger.error(f"Error sending selected media: {e}")
@@ -688,39 +2827,55 @@ class TelegramBot:
     async def perform_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query: str, search_type: str):
         """Perform search on Pixabay"""
         user_id = update.effective_user.id
+        # Translated once here; the session keeps this text for loading later pages
+        query = search_text(query)
         
         # Send searching message
         search_msg = await update.message.reply_text("🔍 جاري البحث...")
         
         # Search Pixabay
-        results = pixabay.search(query, search_type)
+        results = await pixabay.search(query, search_type, RESULTS_PER_PAGE)
+        
+        if results.get("busy"):
+            await search_msg.edit_text("⏳ الخدمة مشغولة الآن، حاول مرة أخرى بعد قليل")
+            return
+        
+        if results.get("error"):
+            await search_msg.edit_text("حدث خطأ مؤقت. حاول مرة أخرى.")
+            return
         
         if not results.get("hits"):
             await search_msg.edit_text("""   ¯\\_(ツ)_/¯
     كلماتك غريبة يا غلام""")
             return
         
-        hits = results["hits"]
+        cursor = ResultCursor.from_response(query, search_type, results)
         
-        # Save search data
-        db.increment_search_count(user_id)
-        db.add_search_history(user_id, query, search_type, len(hits))
-        db.set_user_session(user_id, query, search_type, json.dumps(hits), 0)
+        # Save search data; both writes are flushed in the background
+        # Spelling variants of one query count as one in the stats
+        accounting.record_search(user_id, normalize_query(query), search_type, len(results["hits"]))
+        sessions.set(user_id, query, search_type, cursor, 0)
         
         # Show first result
-        await self.show_search_result(update, context, hits, 0, search_msg)
+        await self.show_search_result(update, context, cursor, 0, search_msg, search_type=search_type)
     
-    async def show_search_result(self, update: Update, context: ContextTypes.DEFAULT_TYPE, results: List[Dict], index: int, message=None, edit_message=False):
+    async def show_search_result(self, update: Update, context: ContextTypes.DEFAULT_TYPE, results: ResultCursor, index: int, message=None, edit_message=False, search_type: str = None):
         """Show search result with navigation"""
         result = results[index]
         
-        # Create navigation keyboard
+        # Create navigation keyboard; each button names its own search and target result
+        user_id = update.effective_user.id
+        prev_index = (index - 1) % len(results)
+        next_index = (index + 1) % len(results)
         keyboard = [
             [
-                InlineKeyboardButton("« السابق", callback_data="nav_prev"),
-                InlineKeyboardButton("التالي »", callback_data="nav_next")
+                InlineKeyboardButton("« السابق", callback_data=encode_nav_token(
+                    "nav", user_id, results.session_id, prev_index, results.page_of(prev_index), results.search_type)),
+                InlineKeyboardButton("التالي »", callback_data=encode_nav_token(
+                    "nav", user_id, results.session_id, next_index, results.page_of(next_index), results.search_type))
             ],
-            [InlineKeyboardButton("اختيار🥇", callback_data="select_result")]
+            [InlineKeyboardButton("اختيار🥇", callback_data=encode_nav_token(
+                "sel", user_id, results.session_id, index, results.page_of(index), results.search_type))]
         ]
         
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -729,10 +2884,13 @@ class TelegramBot:
         caption_text = f"النتيجة {index + 1} من {len(results)}\n"
         caption_text += f"🏷️ {result.get('tags', 'غير محدد')}"
         
-        # Get the current session to determine search type
-        user_id = update.effective_user.id
-        session = db.get_user_session(user_id)
-        search_type = session.get("type", "photo") if session else "photo"
+        # Fall back to the current session to determine search type
+        if search_type is None:
+            session = sessions.get(update.effective_user.id)
+            search_type = session.get("type", "photo") if session else "photo"
+        
+        # Warm the neighbouring results while the user looks at this one
+        self.prefetcher.schedule(update.effective_user.id, results, index, search_type)
         
         # Determine chat context
         if edit_message and update.callback_query:
@@ -746,6 +2904,11 @@ class TelegramBot:
             message_id = None
         
         try:
+            # Switch media and caption in place when the kind of media stays the same
+            if edit_message and update.callback_query:
+                if await self.edit_media(update.callback_query.message, result, search_type, caption_text, reply_markup):
+                    return
+            
             # Delete the old message if it exists
             if edit_message and update.callback_query:
                 await update.callback_query.message.delete()
@@ -753,71 +2916,7 @@ class TelegramBot:
                 await message.delete()
             
             # Send media based on type
-            if search_type == "video" and result.get('videos'):
-                video_url = result['videos'].get('medium', {}).get('url', '')
-                if video_url:
-                    await self.bot.send_video(
-                        chat_id=chat_id,
-                        video=video_url,
-                        caption=caption_text,
-                        reply_markup=reply_markup
-                    )
-                else:
-                    await self.bot.send_message(
-                        chat_id=chat_id,
-                        text=f"{caption_text}\n❌ فيديو غير متوفر",
-                        reply_markup=reply_markup
-                    )
-            elif search_type == "music":
-                # For music, send as audio if available, otherwise show info
-                music_url = result.get('previewURL') or result.get('webformatURL', '')
-                if music_url:
-                    await self.bot.send_audio(
-                        chat_id=chat_id,
-                        audio=music_url,
-                        caption=caption_text,
-                        reply_markup=reply_markup
-                    )
-                else:
-                    await self.bot.send_message(
-                        chat_id=chat_id,
-                        text=f"{caption_text}\n🎵 موسيقى غير متوفرة للتشغيل",
-                        reply_markup=reply_markup
-                    )
-            elif search_type == "gif":
-                # For GIFs, try to send as animation
-                gif_url = result.get('webformatURL', '')
-                if gif_url and gif_url.lower().endswith('.gif'):
-                    await self.bot.send_animation(
-                        chat_id=chat_id,
-                        animation=gif_url,
-                        caption=caption_text,
-                        reply_markup=reply_markup
-                    )
-                else:
-                    # Fallback to photo if not a proper GIF
-                    await self.bot.send_photo(
-                        chat_id=chat_id,
-                        photo=gif_url,
-                        caption=caption_text,
-                        reply_markup=reply_markup
-                    )
-            else:
-                # For photos, illustrations, vectors
-                photo_url = result.get('webformatURL', '')
-                if photo_url:
-                    await self.bot.send_photo(
-                        chat_id=chat_id,
-                        photo=photo_url,
-                        caption=caption_text,
-                        reply_markup=reply_markup
-                    )
-                else:
-                    await self.bot.send_message(
-                        chat_id=chat_id,
-                        text=f"{caption_text}\n❌ صورة غير متوفرة",
-                        reply_markup=reply_markup
-                    )
+            await self.send_media(chat_id, result, search_type, caption_text, reply_markup)
                     
         except Exception as e:
             logger.error(f"Error sending media: {e}")
@@ -836,6 +2935,83 @@ class TelegramBot:
                 reply_markup=reply_markup
             )
     
+    async def edit_media(self, message, result: Dict, search_type: str, caption: str, reply_markup=None) -> bool:
+        """Swap a result into an existing message in place, returning False if it must be resent"""
+        kind, url, rendition, _ = select_media(result, search_type)
+        if not url or message_media_kind(message) != kind:
+            return False
+        
+        input_media = {
+            "photo": InputMediaPhoto,
+            "video": InputMediaVideo,
+            "audio": InputMediaAudio,
+            "animation": InputMediaAnimation
+        }[kind]
+        
+        key = self.media_cache.make_key(result, kind, rendition)
+        file_id = self.media_cache.get(key) if key else None
+        sources = [file_id] if file_id else []
+        if not self.prefetcher.is_bad_url(url):
+            sources.append(url)
+        
+        for source in sources:
+            try:
+                edited = await self.bot.edit_message_media(
+                    chat_id=message.chat_id,
+                    message_id=message.message_id,
+                    media=input_media(media=source, caption=caption),
+                    reply_markup=reply_markup
+                )
+            except BadRequest as e:
+                if "message is not modified" in str(e).lower():
+                    return True
+                logger.warning(f"Edit in place rejected: {e}")
+                if source is file_id:
+                    self.media_cache.discard(key)
+                continue
+            
+            if key and source is url and isinstance(edited, Message):
+                new_file_id = self.media_cache.file_id_from_message(edited, kind)
+                if new_file_id:
+                    self.media_cache.put(key, new_file_id)
+            return True
+        
+        return False
+    
+    async def send_media(self, chat_id: int, result: Dict, search_type: str, caption: str, reply_markup=None):
+        """Send a result's media, reusing a cached Telegram file_id when there is one"""
+        kind, url, rendition, missing_text = select_media(result, search_type)
+        
+        if not url and missing_text:
+            return await self.bot.send_message(
+                chat_id=chat_id,
+                text=f"{caption}\n{missing_text}",
+                reply_markup=reply_markup
+            )
+        
+        # send_photo, send_video, send_audio or send_animation
+        send = getattr(self.bot, f"send_{kind}")
+        
+        key = self.media_cache.make_key(result, kind, rendition)
+        file_id = self.media_cache.get(key) if key else None
+        if file_id:
+            try:
+                return await send(chat_id=chat_id, caption=caption, reply_markup=reply_markup, **{kind: file_id})
+            except BadRequest as e:
+                logger.warning(f"Cached file_id rejected, resending from URL: {e}")
+                self.media_cache.discard(key)
+        
+        if self.prefetcher.is_bad_url(url):
+            # Telegram would fail to fetch it too; go straight to the caller's fallback
+            raise BadRequest(f"Media URL is unreachable: {url}")
+        
+        message = await send(chat_id=chat_id, caption=caption, reply_markup=reply_markup, **{kind: url})
+        if key:
+            new_file_id = self.media_cache.file_id_from_message(message, kind)
+            if new_file_id:
+                self.media_cache.put(key, new_file_id)
+        return message
+    
     async def admin_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle admin commands"""
         if not update.message:
@@ -852,7 +3028,8 @@ class TelegramBot:
             [InlineKeyboardButton("🚫 حظر مستخدم", callback_data="admin_ban")],
             [InlineKeyboardButton("✅ إلغاء حظر مستخدم", callback_data="admin_unban")],
             [InlineKeyboardButton("📢 إدارة القنوات", callback_data="admin_channels")],
-            [InlineKeyboardButton("📤 إرسال إشعار", callback_data="admin_broadcast")]
+            [InlineKeyboardButton("📤 إرسال إشعار", callback_data="admin_broadcast")],
+            [InlineKeyboardButton("🐢 أبطأ التحديثات", callback_data="admin_traces")]
         ]
         
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -870,12 +3047,33 @@ class TelegramBot:
             
         if data == "admin_stats":
             stats = db.get_statistics()
+            cache_stats = pixabay.cache.stats()
+            queue_stats = dispatcher.stats()
+            quota_stats = pixabay.api.scheduler.stats()
+            types_text = "\n".join(f"  • {search_type}: {count}" for search_type, count in stats['searches_today_by_type'].items())
+            top_text = "\n".join(f"  {i}. {query_text} ({count})" for i, (query_text, count) in enumerate(stats['top_queries_today'], 1)) or "  -"
             stats_text = f"""📊 إحصائيات البوت:
 
 👥 عدد المستخدمين: {stats['total_users']}
 🔍 عدد عمليات البحث: {stats['total_searches']}
 📢 القنوات الإجبارية: {stats['mandatory_channels']}
-🚫 المستخدمون المحظورون: {stats['banned_users']}"""
+🚫 المستخدمون المحظورون: {stats['banned_users']}
+
+⏱️ عمليات البحث هذه الساعة: {stats['searches_this_hour']}
+📅 عمليات البحث اليوم: {stats['searches_today']}
+{types_text}
+🔥 الأكثر بحثاً اليوم:
+{top_text}
+
+🗂️ ذاكرة البحث المؤقتة:
+✅ إصابات: {cache_stats['hits']} | ❌ إخفاقات: {cache_stats['misses']}
+♻️ إزالات: {cache_stats['evictions']} | 🔗 طلبات مدمجة: {cache_stats['coalesced']}
+📦 العناصر: {cache_stats['entries']}
+
+🔑 حصة Pixabay: {quota_stats['remaining']} طلب متبقٍ عبر {quota_stats['keys']} مفتاح | ⏳ مشغول: {quota_stats['busy']}
+
+📥 طابور التحديثات: {queue_stats['queue_depth']}/{queue_stats['queue_size']}
+⚙️ قيد المعالجة: {queue_stats['active']} | 🗑️ مُسقطة: {queue_stats['shed']}"""
             
             await query.edit_message_text(stats_text)
         
@@ -904,6 +3102,23 @@ class TelegramBot:
             
             await query.edit_message_text(channels_text, reply_markup=reply_markup)
         
+        elif data == "admin_traces":
+            traces = tracer.slowest(5)
+            lines = [f"🐢 أبطأ التحديثات (عينة {tracer.sample_rate:.0%}، {tracer.sampled} تحديث):"]
+            for i, trace in enumerate(traces, 1):
+                route = trace["route"]
+                breakdown = ", ".join(f"{kind} {ms:.0f}ms" for kind, ms in sorted(trace["breakdown"].items(), key=lambda item: -item[1]))
+                longest = sorted(trace["spans"], key=lambda span: -span[3])[:3]
+                spans_text = "\n".join(f"     ↳ {kind}:{name} {ms:.0f}ms" for kind, name, _, ms in longest)
+                lines.append(f"\n{i}. {trace['duration_ms']:.0f}ms — {route['handler']}/{route['prefix'] or '-'} ({trace['started_at']})")
+                lines.append(f"   {breakdown or '-'}")
+                if spans_text:
+                    lines.append(spans_text)
+            if not traces:
+                lines.append("\nلا توجد تحديثات مسجلة بعد")
+            
+            await query.edit_message_text("\n".join(lines)[:4000])
+        
         elif data == "admin_broadcast":
             await query.edit_message_text("أرسل الرسالة للبث لجميع المستخدمين:")
             context.user_data["admin_action"] = "broadcast"
@@ -951,6 +3166,7 @@ class TelegramBot:
                 channel_username = text[1:]  # Remove @
                 channel_id = text
                 db.add_mandatory_channel(channel_id, channel_username, user_id)
+                self.subscriptions.invalidate()
                 await update.message.reply_text(f"✅ تم إضافة القناة {text}")
             else:
                 await update.message.reply_text("❌ يجب أن يبدأ معرف القناة بـ @")
@@ -958,116 +3174,705 @@ class TelegramBot:
         
         elif action == "remove_channel":
             db.remove_mandatory_channel(text)
+            self.subscriptions.invalidate()
             await update.message.reply_text(f"✅ تم حذف القناة {text}")
             context.user_data.pop("admin_action", None)
         
         elif action == "broadcast":
-            # Get all users
-            conn = sqlite3.connect(db.db_name)
-            cursor = conn.cursor()
-            cursor.execute('SELECT user_id FROM users WHERE is_banned = 0')
-            users = cursor.fetchall()
-            conn.close()
-            
-            success_count = 0
-            for user_tuple in users:
-                try:
-                    await self.bot.send_message(chat_id=user_tuple[0], text=text)
-                    success_count += 1
-                except Exception as e:
-                    logger.error(f"Failed to send message to {user_tuple[0]}: {e}")
-            
-            await update.message.reply_text(f"✅ تم إرسال الرسالة لـ {success_count} مستخدم")
+            # Runs in the background; progress is reported in its own message
+            await self.broadcasts.start(user_id, update.effective_chat.id, text)
             context.user_data.pop("admin_action", None)
 
 # Initialize bot
-bot = TelegramBot(BOT_TOKEN)
+bot = LazyComponent(lambda: TelegramBot(BOT_TOKEN))
 
-# Check if we're running on Render (webhook mode only)
-def is_render_environment():
-    """Check if running on Render platform"""
-    return os.environ.get('RENDER_EXTERNAL_URL') is not None or os.environ.get('RENDER') is not None
+def update_route(update_data: Dict) -> tuple:
+    """Label raw update data by handler and callback prefix, keeping label values bounded"""
+    callback = update_data.get("callback_query")
+    if callback is not None:
+        prefix = (callback.get("data") or "").split(":", 1)[0].split("_", 1)[0]
+        return (("handler", "callback"), ("prefix", prefix if prefix in METRICS_CALLBACK_PREFIXES else "other"))
+    message = update_data.get("message")
+    if message is not None:
+        text = message.get("text") or ""
+        if text.startswith("/"):
+            command = text[1:].split(maxsplit=1)[0].split("@", 1)[0] if len(text) > 1 else ""
+            return (("handler", "command"), ("prefix", command if command in METRICS_COMMANDS else "other"))
+        return (("handler", "message"), ("prefix", ""))
+    return (("handler", "other"), ("prefix", ""))
 
-async def main():
-    """Main function - Render webhook mode only"""
-    logger.info("🚀 Starting Pixabay Bot - Render Deployment Only")
+class UpdateDispatcher:
+    """Feeds webhook updates to a fixed pool of workers on one persistent event loop"""
     
-    # Only proceed if we're on Render
-    if not is_render_environment():
-        logger.error("❌ This bot is configured to run only on Render.com")
-        logger.error("❌ Please deploy this bot to Render.com to use it")
-        return
+    def __init__(self, application: Application, workers: int = UPDATE_WORKERS, max_queue: int = UPDATE_QUEUE_SIZE):
+        self.application = application
+        self.workers = workers
+        self.max_queue = max_queue
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        # Workers hold queued updates until the application has been started
+        self._ready: Optional[asyncio.Event] = None
+        # Updates accepted but not yet picked up by a worker, tracked outside the loop
+        self._depth = 0
+        self._depth_lock = threading.Lock()
+        self.active = 0
+        self.processed = 0
+        self.failed = 0
+        self.shed = 0
     
-    # Initialize bot
-    await bot.bot.initialize()
-    await bot.application.initialize()
-    logger.info("🤖 Bot initialized")
+    def start(self):
+        """Start the event loop thread and the update workers"""
+        if self._thread is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        
+        def run_loop():
+            asyncio.set_event_loop(self.loop)
+            self._queue = asyncio.Queue()
+            self._ready = asyncio.Event()
+            self._worker_tasks = [self.loop.create_task(self._worker()) for _ in range(self.workers)]
+            self.loop.call_soon(ready.set)
+            self.loop.run_forever()
+        
+        self._thread = threading.Thread(target=run_loop, name="update-loop", daemon=True)
+        self._thread.start()
+        ready.wait()
+        logger.info(f"Update dispatcher started with {self.workers} workers, queue size {self.max_queue}")
+    
+    def run(self, coro, timeout: float = None):
+        """Run a coroutine on the dispatcher loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+    
+    def submit(self, update_data: Dict) -> bool:
+        """Queue raw update data from any thread, returning False if it was shed"""
+        with self._depth_lock:
+            if self._depth >= self.max_queue:
+                self.shed += 1
+                return False
+            self._depth += 1
+        self.loop.call_soon_threadsafe(self._queue.put_nowait, update_data)
+        return True
+    
+    def set_ready(self):
+        """Let the workers start processing queued updates"""
+        self.loop.call_soon_threadsafe(self._ready.set)
+    
+    async def _worker(self):
+        """Process queued updates until cancelled"""
+        await self._ready.wait()
+        while True:
+            update_data = await self._queue.get()
+            with self._depth_lock:
+                self._depth -= 1
+            self.active += 1
+            start = time.perf_counter()
+            outcome = "error"
+            route = update_route(update_data)
+            trace = tracer.start(update_data.get("update_id"), route)
+            try:
+                update = Update.de_json(update_data, self.application.bot)
+                if update:
+                    await self.application.process_update(update)
+                self.processed += 1
+                outcome = "ok"
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Error processing update {update_data.get('update_id', 'unknown')}: {e}")
+            finally:
+                self.active -= 1
+                self._queue.task_done()
+                metrics.observe("bot_update_seconds", time.perf_counter() - start, route + (("outcome", outcome),))
+                if trace is not None:
+                    tracer.finish(trace, outcome)
+    
+    def stats(self) -> Dict:
+        """Get queue depth and processing counters"""
+        return {
+            "ready": self._ready is not None and self._ready.is_set(),
+            "queue_depth": self._depth,
+            "queue_size": self.max_queue,
+            "workers": self.workers,
+            "active": self.active,
+            "processed": self.processed,
+            "failed": self.failed,
+            "shed": self.shed
+        }
+    
+    async def _drain(self, timeout: float):
+        """Wait for queued updates to finish, then cancel the workers"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Shutting down with {self._depth} updates still queued")
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+    
+    def stop(self, shutdown_coro=None, timeout: float = 10):
+        """Drain the queue, run an optional shutdown coroutine and stop the loop"""
+        if self._thread is None:
+            return
+        try:
+            self.run(self._drain(timeout))
+            if shutdown_coro is not None:
+                self.run(shutdown_coro, timeout)
+        except Exception as e:
+            logger.error(f"Error stopping update dispatcher: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self._thread = None
+
+# Initialize update dispatcher; the application behind it is built during startup, not here
+dispatcher = UpdateDispatcher(LazyComponent(lambda: bot.application))
+metrics.gauge("bot_update_queue_depth", "Updates accepted but not yet picked up by a worker", lambda: dispatcher.stats()["queue_depth"])
+metrics.gauge("bot_update_queue_size", "Maximum number of queued updates", lambda: dispatcher.max_queue)
+metrics.gauge("bot_update_active", "Updates being processed right now", lambda: dispatcher.active)
+metrics.gauge("bot_updates_processed_total", "Updates processed successfully", lambda: dispatcher.processed, kind="counter")
+metrics.gauge("bot_updates_failed_total", "Updates that raised while processing", lambda: dispatcher.failed, kind="counter")
+metrics.gauge("bot_updates_shed_total", "Updates dropped because the queue was full", lambda: dispatcher.shed, kind="counter")
+
+def update_user_id(update_data: Dict) -> Optional[int]:
+    """Find the id of the user an update comes from without deserializing it"""
+    for key, value in update_data.items():
+        if key != "update_id" and isinstance(value, dict):
+            user = value.get("from") or value.get("user")
+            return user.get("id") if isinstance(user, dict) else None
+    return None
+
+class ShardRouter:
+    """Routes updates by user to worker processes, each running its own dispatcher and bot"""
+    
+    def __init__(self, count: int = UPDATE_SHARDS, max_queue: int = SHARD_QUEUE_SIZE):
+        self.count = count
+        self.max_queue = max_queue
+        # Workers are spawned, not forked, so they do not inherit the front end's threads and connections
+        self._context = multiprocessing.get_context("spawn")
+        self._inboxes: List[Any] = []
+        # Metrics and traces sent back by the shards
+        self._telemetry = None
+        self._telemetry_thread: Optional[threading.Thread] = None
+        self._processes: List[Any] = []
+        # Per shard: updates sent by this process; the rest of the counters are written by the shards
+        self._forwarded = [0] * count
+        self._lock = threading.Lock()
+        self._stats = None
+        self.shed = 0
+    
+    def prepare(self):
+        """Create the shard queues so updates can be accepted before the workers are running"""
+        if self._inboxes:
+            return
+        self._stats = self._context.Array("q", self.count * len(SHARD_STATS_FIELDS), lock=False)
+        self._inboxes = [self._context.Queue() for _ in range(self.count)]
+        self._telemetry = self._context.Queue()
+    
+    def start(self):
+        """Spawn the worker processes"""
+        self.prepare()
+        if self._processes:
+            return
+        self._telemetry_thread = threading.Thread(target=self._collect_telemetry, name="shard-telemetry", daemon=True)
+        self._telemetry_thread.start()
+        for index, inbox in enumerate(self._inboxes):
+            process = self._context.Process(target=run_shard, args=(index, inbox, self._stats, self._telemetry),
+                                            name=f"shard-{index}", daemon=True)
+            process.start()
+            self._processes.append(process)
+        logger.info(f"Started {self.count} update shards")
+    
+    def _collect_telemetry(self):
+        """Merge the metrics and traces each shard publishes into this process's registry and tracer"""
+        while True:
+            try:
+                report = self._telemetry.get()
+                if report is None:
+                    return
+                index = report["shard"]
+                metrics.set_remote((("shard", index),), report["metrics"])
+                tracer.set_remote(f"shard-{index}", [dict(trace, shard=index) for trace in report["traces"]])
+            except Exception as e:
+                logger.error(f"Failed to collect shard telemetry: {e}")
+    
+    def shard_of(self, update_data: Dict) -> int:
+        """Pick the shard owning an update's user; updates without a user go to shard 0"""
+        user_id = update_user_id(update_data)
+        return user_id % self.count if isinstance(user_id, int) else 0
+    
+    def submit(self, update_data: Dict) -> bool:
+        """Send raw update data to its shard, returning False if it was shed"""
+        index = self.shard_of(update_data)
+        received = self._stats[index * len(SHARD_STATS_FIELDS)]
+        with self._lock:
+            if self._forwarded[index] - received >= self.max_queue:
+                self.shed += 1
+                return False
+            self._forwarded[index] += 1
+        self._inboxes[index].put(update_data)
+        return True
+    
+    def stats(self) -> Dict:
+        """Get per-shard queue depths and counters"""
+        fields = len(SHARD_STATS_FIELDS)
+        shards = []
+        for index in range(self.count):
+            shard = dict(zip(SHARD_STATS_FIELDS, self._stats[index * fields:(index + 1) * fields])) if self._stats else {}
+            shard["forwarded"] = self._forwarded[index]
+            shard["ipc_depth"] = self._forwarded[index] - shard.get("received", 0)
+            shard["alive"] = index < len(self._processes) and self._processes[index].is_alive()
+            shards.append(shard)
+        return {
+            "queue_depth": max((shard["ipc_depth"] + shard.get("queue_depth", 0) for shard in shards), default=0),
+            "queue_size": self.max_queue,
+            "shed": self.shed,
+            "shards": shards
+        }
+    
+    def stop(self, timeout: float = 30):
+        """Let every shard finish its queued updates, then wait for it to exit"""
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"{process.name} did not stop in time, terminating")
+                process.terminate()
+        self._processes = []
+        if self._telemetry_thread is not None:
+            self._telemetry.put(None)
+            self._telemetry_thread.join(timeout=5)
+            self._telemetry_thread = None
+
+def publish_telemetry(index: int, telemetry):
+    """Send this shard's metrics and slowest traces to the front end"""
+    telemetry.put({"shard": index, "metrics": metrics.snapshot(), "traces": tracer.slowest()})
+
+def sync_shard(index: int, stats, telemetry, stop_event: threading.Event):
+    """Publish this shard's counters and telemetry and pick up ban and channel changes made by other shards"""
+    base = index * len(SHARD_STATS_FIELDS)
+    # Unknown until the first successful read, which then reloads once
+    shared_version = None
+    next_sync = time.monotonic() + SHARD_SYNC_INTERVAL
+    while not stop_event.wait(0.2):
+        try:
+            current = dispatcher.stats()
+            for offset, field in enumerate(SHARD_STATS_FIELDS[1:], 1):
+                stats[base + offset] = int(current[field])
+            
+            if time.monotonic() >= next_sync:
+                next_sync = time.monotonic() + SHARD_SYNC_INTERVAL
+                publish_telemetry(index, telemetry)
+                version = db.get_state("shared_version")
+                if version != shared_version:
+                    db.reload_banned_ids()
+                    dispatcher.loop.call_soon_threadsafe(bot.subscriptions.invalidate)
+                    # Only after the reload succeeded, so a failed one is retried next interval
+                    shared_version = version
+        except Exception as e:
+            logger.error(f"Shard {index} sync failed: {e}")
+
+def run_shard(index: int, inbox, stats, telemetry):
+    """Worker process entry point: process the updates routed to one shard"""
+    # The front end coordinates shutdown; finish queued updates instead of dying mid-update
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger.info(f"Shard {index} starting")
     
-    # Set webhook for Render deployment
-    webhook_url = "https://telegram-oihp.onrender.com/webhook"
+    base = index * len(SHARD_STATS_FIELDS)
+    dispatcher.start()
+    dispatcher.run(start_bot(register_updates=False, maintenance=False))
+    stop_event = threading.Event()
+    threading.Thread(target=sync_shard, args=(index, stats, telemetry, stop_event), name="shard-sync",
+                     daemon=True).start()
     
+    received = 0
     try:
-        # Delete existing webhook first
-        await bot.bot.delete_webhook()
-        await asyncio.sleep(1)
-        
-        # Set new webhook
-        result = await bot.bot.set_webhook(
-            url=webhook_url,
-            allowed_updates=["message", "callback_query"]
-        )
+        while True:
+            update_data = inbox.get()
+            if update_data is None:
+                break
+            received += 1
+            stats[base] = received
+            if not dispatcher.submit(update_data):
+                logger.warning(f"Shard {index} queue full, dropped update {update_data.get('update_id', 'unknown')}")
+    finally:
+        stop_event.set()
+        dispatcher.stop(stop_bot())
+        publish_telemetry(index, telemetry)
+
+# Initialize update shards; with a single shard updates are handled in this process
+shards = ShardRouter()
+ingress = shards if UPDATE_SHARDS > 1 else dispatcher
+metrics.gauge("bot_shard_queue_depth", "Updates queued for each shard process, in transit or in its dispatcher",
+              lambda: {(("shard", i),): shard["ipc_depth"] + shard.get("queue_depth", 0)
+                       for i, shard in enumerate(shards.stats()["shards"])} if shards._inboxes else {})
+
+# Telegram puts update_id first, so it can be read without parsing the rest of the body
+_UPDATE_ID_PREFIX = re.compile(rb'\s*\{\s*"update_id"\s*:\s*(\d+)')
+
+def peek_update_id(body: bytes) -> Optional[int]:
+    """Read the update_id at the start of a raw update, or None if it is not there"""
+    match = _UPDATE_ID_PREFIX.match(body)
+    return int(match.group(1)) if match else None
+
+class UpdateDeduplicator:
+    """Drops repeated update_ids before they are parsed or processed
+    
+    Recent ids live in a ring indexed by update_id modulo the window, so a lookup is one slot
+    comparison. The high-water mark is persisted so retries of updates accepted before a restart
+    are still recognised. An id further below the high-water mark than the window cannot be a retry
+    the ring would have caught, so it is taken as Telegram restarting the sequence.
+    """
+    
+    def __init__(self, database: Database, window: int = UPDATE_DEDUP_WINDOW,
+                 persist_interval: float = UPDATE_DEDUP_PERSIST_INTERVAL):
+        self.db = database
+        self.window = window
+        self.persist_interval = persist_interval
+        self._ring = [-1] * window
+        self.high_water = 0
+        # Everything at or below this was accepted before the last restart
+        self._floor = 0
+        self._persisted = 0
+        self._persisted_at = 0.0
+        self._lock = threading.Lock()
+        # The HTTP server binds before the database is opened; claims wait until the mark is restored
+        self._loaded = threading.Event()
+        self.duplicates = 0
+    
+    def load(self):
+        """Restore the high-water mark persisted by the previous run"""
+        stored = int(self.db.get_state("update_high_water") or 0)
+        with self._lock:
+            self._floor = stored
+            self.high_water = max(self.high_water, stored)
+            self._persisted = stored
+        self._loaded.set()
+    
+    def claim(self, update_id: int, timeout: float = 30) -> bool:
+        """Mark an update as accepted, returning False if it was seen before"""
+        if not self._loaded.wait(timeout):
+            logger.warning(f"Update {update_id} accepted before the update_id high-water mark was loaded")
+        with self._lock:
+            if self.high_water - update_id >= self.window:
+                # Telegram restarts the sequence at a random id after a long quiet period
+                logger.info(f"update_id sequence restarted at {update_id}")
+                self._ring = [-1] * self.window
+                self.high_water = self._floor = 0
+            slot = update_id % self.window
+            if update_id <= self._floor or self._ring[slot] == update_id:
+                self.duplicates += 1
+                return False
+            self._ring[slot] = update_id
+            if update_id > self.high_water:
+                self.high_water = update_id
+        
+        if time.monotonic() - self._persisted_at >= self.persist_interval:
+            self.persist()
+        return True
+    
+    def release(self, update_id: int):
+        """Forget a claimed update that could not be accepted, so a retry gets through"""
+        with self._lock:
+            slot = update_id % self.window
+            if self._ring[slot] == update_id:
+                self._ring[slot] = -1
+    
+    def persist(self):
+        """Store the high-water mark if it moved"""
+        if not self._loaded.is_set():
+            # Writing now would overwrite the mark load() has yet to read
+            return
+        self._persisted_at = time.monotonic()
+        high_water = self.high_water
+        if high_water != self._persisted:
+            self._persisted = high_water
+            self.db.set_state("update_high_water", str(high_water))
+    
+    def stats(self) -> Dict:
+        return {"high_water": self.high_water, "duplicates": self.duplicates}
+
+# Initialize update de-duplication
+deduplicator = UpdateDeduplicator(db)
+metrics.gauge("bot_updates_duplicate_total", "Repeated update deliveries dropped", lambda: deduplicator.duplicates,
+              kind="counter")
+
+class UpdatePoller:
+    """Long-polls getUpdates and feeds each batch to the update dispatcher"""
+    
+    def __init__(self, token: str, update_dispatcher, database: Database,
+                 timeout: int = POLL_TIMEOUT, limit: int = POLL_LIMIT,
+                 allowed_updates: List[str] = WEBHOOK_ALLOWED_UPDATES):
+        self.url = f"{TELEGRAM_API_URL}{token}/getUpdates"
+        self.dispatcher = update_dispatcher
+        self.db = database
+        self.timeout = timeout
+        self.limit = limit
+        self.allowed_updates = allowed_updates
+        # Next update_id to request; everything below it has been handed to the dispatcher
+        self.offset = 0
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+        self.polls = 0
+        self.received = 0
+        self.errors = 0
+    
+    def start(self):
+        """Start polling from the stored offset; must run on the dispatcher loop"""
+        if self._task is not None:
+            return
+        self.offset = int(self.db.get_state("poll_offset") or 0)
+        # The read timeout must outlast the long poll itself
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(self.timeout + 10, connect=10))
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"📥 Polling for updates from offset {self.offset}")
+    
+    async def stop(self):
+        """Stop polling and close the HTTP session"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self._client.aclose()
+        self._client = None
+    
+    async def _fetch(self) -> List[Dict]:
+        """Fetch the next batch of raw updates, waiting up to the poll timeout for one to arrive"""
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = await self._client.post(self.url, json={
+                "offset": self.offset,
+                "limit": self.limit,
+                "timeout": self.timeout,
+                "allowed_updates": self.allowed_updates
+            })
+            status = str(response.status_code)
+        finally:
+            metrics.observe("telegram_api_request_seconds", time.perf_counter() - start,
+                            (("method", "getUpdates"), ("status", status)))
+        
+        payload = response.json()
+        if payload.get("ok"):
+            return payload["result"]
+        retry_after = (payload.get("parameters") or {}).get("retry_after")
+        if retry_after:
+            logger.warning(f"getUpdates rate limited, retrying in {retry_after}s")
+            await asyncio.sleep(retry_after)
+            return []
+        raise RuntimeError(f"getUpdates failed: {payload.get('error_code')} {payload.get('description')}")
+    
+    async def _run(self):
+        backoff = 1
+        while True:
+            # Leave updates with Telegram rather than shedding them when the workers are behind
+            while self.dispatcher.stats()["queue_depth"] > self.dispatcher.max_queue - self.limit:
+                await asyncio.sleep(0.05)
+            
+            try:
+                updates = await self._fetch()
+                self.polls += 1
+                backoff = 1
+            except (httpx.HTTPError, ValueError, RuntimeError) as e:
+                self.errors += 1
+                logger.error(f"Polling error: {e!r}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            
+            if not updates:
+                continue
+            for update_data in updates:
+                if not deduplicator.claim(update_data["update_id"]):
+                    continue
+                if not self.dispatcher.submit(update_data):
+                    logger.warning(f"Update queue full, dropped update {update_data.get('update_id', 'unknown')}")
+            self.received += len(updates)
+            
+            # The next request confirms this batch to Telegram, so persist the offset first
+            self.offset = updates[-1]["update_id"] + 1
+            self.db.set_state("poll_offset", str(self.offset))
+    
+    def stats(self) -> Dict:
+        """Get polling counters"""
+        return {
+            "offset": self.offset,
+            "polls": self.polls,
+            "received": self.received,
+            "errors": self.errors
+        }
+
+# Initialize update poller
+poller = UpdatePoller(BOT_TOKEN, ingress, db)
+
+# Check if we're running on Render
+def is_render_environment():
+    """Check if running on Render platform"""
+    return os.environ.get('RENDER_EXTERNAL_URL') is not None or os.environ.get('RENDER') is not None
+
+def use_polling() -> bool:
+    """Check whether updates are pulled with getUpdates instead of received through the webhook"""
+    # Polling removes the webhook, so it is never picked implicitly
+    return UPDATE_MODE == "polling"
+
+async def ensure_webhook(url: str = WEBHOOK_URL, allowed_updates: List[str] = WEBHOOK_ALLOWED_UPDATES):
+    """Register the webhook, or remove it when url is empty, unless Telegram already has the same settings"""
+    try:
+        info = await bot.bot.get_webhook_info()
+        if not url:
+            # getUpdates is refused while a webhook is set
+            if info.url == WEBHOOK_URL:
+                logger.error(f"❌ Refusing to remove the production webhook {WEBHOOK_URL}; "
+                             f"delete it by hand to move this bot to polling")
+            elif info.url:
+                await bot.bot.delete_webhook()
+                logger.info("✅ Webhook removed for polling")
+            return
+        if info.url == url and sorted(info.allowed_updates or ()) == sorted(allowed_updates):
+            logger.info(f"✅ Webhook already set: {url}")
+            return
+        
+        # setWebhook replaces the previous registration, so there is nothing to delete first
+        result = await bot.bot.set_webhook(url=url, allowed_updates=allowed_updates)
         
         if result:
-            logger.info(f"✅ Webhook set successfully: {webhook_url}")
+            logger.info(f"✅ Webhook set successfully: {url}")
         else:
-            logger.error(f"❌ Failed to set webhook: {webhook_url}")
+            logger.error(f"❌ Failed to set webhook: {url}")
             
     except Exception as e:
         logger.error(f"Failed to set webhook: {e}")
+
+async def start_bot(serve_updates: bool = True, register_updates: bool = True, maintenance: bool = True):
+    """Initialize the bot and start the application
+    
+    With sharded updates the front end registers the webhook or polling and runs maintenance
+    (history retention, broadcast resumption), while the shard processes only serve updates.
+    """
+    with startup.phase("database"):
+        db.get_connection()
+        # Before any update is handled, as the VACUUM holds an exclusive lock on the file
+        if maintenance and DB_INCREMENTAL_VACUUM:
+            db.enable_incremental_vacuum()
+        if register_updates:
+            deduplicator.load()
     
-    await bot.application.start()
-    logger.info("🚀 Bot started successfully in webhook mode on Render")
+    if not serve_updates:
+        with startup.phase("shards"):
+            shards.start()
     
-    # Start Flask webhook server
-    from flask import Flask, request
+    with startup.phase("bot"):
+        # First access builds the bot, its application and handlers
+        bot.application
+    
+    with startup.phase("initialize"):
+        if serve_updates:
+            await asyncio.gather(bot.bot.initialize(), bot.application.initialize())
+        else:
+            await bot.bot.initialize()
+    logger.info("🤖 Bot initialized")
+    
+    if register_updates:
+        with startup.phase("webhook"):
+            await ensure_webhook("" if use_polling() else WEBHOOK_URL)
+    
+    with startup.phase("application"):
+        if serve_updates:
+            await bot.application.start()
+            bot.media_cache.load()
+            sessions.start()
+            accounting.start()
+        if maintenance:
+            retention.start()
+            await bot.broadcasts.resume()
+    
+    if serve_updates:
+        dispatcher.set_ready()
+    if register_updates and use_polling():
+        poller.start()
+    startup.mark_ready()
+
+async def stop_bot():
+    """Stop the application and release its resources"""
+    await bot.broadcasts.stop()
+    if bot.application.running:
+        await bot.application.stop()
+    await bot.application.shutdown()
+    await bot.bot.shutdown()
+    await pixabay.close()
+    sessions.stop()
+    accounting.stop()
+    retention.stop()
+    # Last, as the writers above flush through it
+    db.close()
+
+def create_app() -> Flask:
+    """Build the Flask app serving the webhook and status endpoints"""
     app = Flask(__name__)
     
     @app.route('/webhook', methods=['POST'])
     def webhook():
         """Handle webhook requests"""
+        claimed = None
         try:
-            update_data = request.get_json(force=True)
-            if not update_data:
-                logger.warning("Received empty webhook data")
-                return 'OK'
+            # Drop retried deliveries before parsing the body
+            update_id = peek_update_id(request.get_data())
+            update_data = None
+            if update_id is None:
+                update_data = request.get_json(force=True)
+                if not update_data:
+                    logger.warning("Received empty webhook data")
+                    return 'OK'
+                update_id = update_data.get('update_id')
+            if update_id is not None:
+                if not deduplicator.claim(update_id):
+                    logger.info(f"Dropped duplicate update {update_id}")
+                    return 'OK', 200
+                claimed = update_id
+            if update_data is None:
+                update_data = request.get_json(force=True)
                 
             logger.info(f"Received webhook update: {update_data.get('update_id', 'unknown')}")
             
-            try:
-                update = Update.de_json(update_data, bot.bot)
-                if update:
-                    # Handle the update in a new thread to avoid blocking
-                    def process_update():
-                        try:
-                            loop = asyncio.new_event_loop()
-                            asyncio.set_event_loop(loop)
-                            loop.run_until_complete(bot.application.process_update(update))
-                            loop.close()
-                        except Exception as e:
-                            logger.error(f"Error processing update in thread: {e}")
-                    
-                    thread = threading.Thread(target=process_update, daemon=True)
-                    thread.start()
-                    
-            except Exception as e:
-                logger.error(f"Error creating update object: {e}")
+            # Shed load when the queue is full; answering 200 stops Telegram from retrying
+            if not ingress.submit(update_data):
+                logger.warning(f"Update queue full, dropped update {update_data.get('update_id', 'unknown')}")
                 
             return 'OK', 200
             
         except Exception as e:
             logger.error(f"Webhook error: {e}")
+            # Telegram will retry, so let the retry through
+            if claimed is not None:
+                deduplicator.release(claimed)
             return 'Error', 500
     
+    @app.route('/status', methods=['GET'])
+    def status():
+        """Update queue status"""
+        status = ingress.stats()
+        status["deduplication"] = deduplicator.stats()
+        if use_polling():
+            status["polling"] = poller.stats()
+        return status
+    
+    @app.route('/traces', methods=['GET'])
+    def traces():
+        """Slowest sampled updates with their span breakdown"""
+        return {
+            "sample_rate": tracer.sample_rate,
+            "sampled": tracer.sampled,
+            "slowest": tracer.slowest(request.args.get('limit', type=int))
+        }
+    
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        """Prometheus metrics"""
+        return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    
     @app.route('/', methods=['GET'])
     def home():
         """Home page for Render deployment"""
@@ -1117,14 +3922,59 @@ async def main():
         """Health check endpoint"""
         return 'OK'
     
-    # Run Flask server
-    port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=False)
+    @app.route('/ready', methods=['GET'])
+    def ready():
+        """Readiness endpoint with the startup timing breakdown"""
+        return startup.summary(), 200 if startup.ready.is_set() else 503
+    
+    return app
+
+def main():
+    """Main function - webhook mode on Render, long polling only when asked for"""
+    if not UPDATE_MODE and not is_render_environment():
+        logger.error("❌ Outside Render set UPDATE_MODE=polling (or webhook) to choose how updates arrive")
+        return
+    
+    mode = "polling" if use_polling() else "webhook"
+    logger.info(f"🚀 Starting Pixabay Bot in {mode} mode")
+    
+    # Turn SIGTERM into a normal exit so queued updates and sessions get flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    startup.record("module load", time.perf_counter() - startup.began)
+    
+    # All bot work runs on the dispatcher's single event loop; updates wait in its queue until start_bot finishes
+    with startup.phase("dispatcher"):
+        dispatcher.start()
+        if ingress is shards:
+            shards.prepare()
+    
+    # Bind the HTTP server before the slow startup work so a waking instance answers immediately
+    with startup.phase("http bind"):
+        port = int(os.environ.get('PORT', 5000))
+        server = make_server('0.0.0.0', port, create_app(), threaded=True)
+    
+    def run_startup():
+        try:
+            dispatcher.run(start_bot(serve_updates=ingress is dispatcher))
+            logger.info(f"🚀 Bot started successfully in {mode} mode")
+        except Exception as e:
+            startup.failed = repr(e)
+            logger.error(f"❌ Startup failed: {e}")
+            server.shutdown()
+    
+    threading.Thread(target=run_startup, name="startup", daemon=True).start()
+    
+    # Run Flask server; in polling mode it only serves the status endpoints
+    try:
+        server.serve_forever()
+    finally:
+        # Stop taking new updates before draining the queues
+        dispatcher.run(poller.stop(), 10)
+        if ingress is shards:
+            shards.stop()
+        deduplicator.persist()
+        dispatcher.stop(stop_bot())
 
 if __name__ == '__main__':
-    if is_render_environment():
-        asyncio.run(main())
-    else:
-        print("❌ هذا البوت مخصص للعمل على Render.com فقط")
-        print("❌ يرجى نشر البوت على Render.com لاستخدامه") 
-``'
+    main() 